@@ -23,7 +23,7 @@ REQUIRED = [
 
 # What packages are optional?
 EXTRAS = {
-    # 'fancy feature': ['django'],
+    'async': ['httpx'],
 }
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -0,0 +1,128 @@
+import datetime
+import json
+import math
+import os
+
+import pytest
+from marshmallow import fields
+
+from visma.api import VismaQueryCompiler, VismaAPIException
+from visma.base import VismaModel
+from visma.models import PaginatedResponse
+
+# Benchmarks only run when VISMA_BENCHMARK is set, use
+# VISMA_BENCHMARK=1 pytest -s to see the results.
+benchmark = pytest.mark.skipif(not os.environ.get('VISMA_BENCHMARK'),
+                               reason='set VISMA_BENCHMARK=1 to run')
+
+
+class Thing(VismaModel):
+    id = fields.Integer(data_key='Id', allow_none=True)
+    name = fields.String(data_key='Name', allow_none=True)
+
+    class Meta:
+        endpoint = '/things'
+        allowed_methods = ['list', 'get', 'create', 'update', 'delete']
+        envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+
+
+class FakeResponse:
+
+    def __init__(self, data):
+        self.data = data
+        self.content = json.dumps(data).encode()
+        self.elapsed = datetime.timedelta(0)
+
+    def json(self):
+        return self.data
+
+
+class FakeAPI:
+    """
+    Serves the rows it is given as a paginated Visma endpoint and records the
+    query parameters of every call.
+    """
+    QUERY_COMPILER_CLASS = VismaQueryCompiler
+    TIMEOUT_EXCEPTIONS = (TimeoutError,)
+
+    def __init__(self, rows, max_concurrent_pages=1):
+        self.rows = rows
+        self.max_concurrent_pages = max_concurrent_pages
+        self.page_size = None
+        self.adaptive_page_size = False
+        self.max_page_latency = 2.0
+        self.max_page_payload = 2 * 1024 * 1024
+        self.page_sizers = dict()
+        self.max_timeout_page_size = None
+        self.calls = []
+        self.sent = []
+
+    def get(self, endpoint, params=None, **kwargs):
+        if params is None:
+            return FakeResponse(self.rows[self._get_pk(endpoint)])
+        self.calls.append(dict(params))
+        page_size = params['$pagesize']
+        page = params['$page']
+        if (self.max_timeout_page_size is not None and
+                page_size > self.max_timeout_page_size):
+            raise TimeoutError
+        rows = self.get_rows(endpoint, params)
+        data = rows[(page - 1) * page_size:page * page_size]
+        return FakeResponse({
+            'Data': data,
+            'Meta': {'CurrentPage': page,
+                     'PageSize': page_size,
+                     'TotalNumberOfPages': math.ceil(len(rows) / page_size),
+                     'TotalNumberOfResults': len(rows),
+                     'ServerTimeUtc': '2018-06-21T16:23:13.1083743Z'}})
+
+    def get_rows(self, endpoint, params):
+        return self.rows
+
+    def post(self, endpoint, data=None, **kwargs):
+        data = json.loads(data)
+        self.sent.append(data)
+        self.rows.append(dict(data, Id=len(self.rows)))
+        return FakeResponse(self.rows[-1])
+
+    def put(self, endpoint, data=None, **kwargs):
+        data = json.loads(data)
+        self.sent.append(data)
+        pk = self._get_pk(endpoint)
+        self.rows[pk] = dict(self.rows[pk], **data)
+        return FakeResponse(self.rows[pk])
+
+    def delete(self, endpoint, **kwargs):
+        pk = self._get_pk(endpoint)
+        self.rows[pk] = None
+        return FakeResponse(None)
+
+    def _get_pk(self, endpoint):
+        pk = int(endpoint.rsplit('/', 1)[1])
+        if pk >= len(self.rows) or self.rows[pk] is None:
+            raise VismaAPIException(f'HTTP:404, {endpoint}')
+        return pk
+
+
+class AsyncFakeAPI(FakeAPI):
+
+    async def get(self, endpoint, params=None, **kwargs):
+        return super().get(endpoint, params=params, **kwargs)
+
+
+@pytest.fixture
+def fake_api():
+    original_api = Thing.objects.api
+    api = FakeAPI([{'Id': i, 'Name': f'Thing {i}'} for i in range(120)])
+    Thing.objects.api = api
+    yield api
+    Thing.objects.api = original_api
+
+
+@pytest.fixture
+def async_fake_api():
+    original_api = Thing.objects.api
+    api = AsyncFakeAPI([{'Id': i, 'Name': f'Thing {i}'} for i in range(120)])
+    Thing.objects.api = api
+    yield api
+    Thing.objects.api = original_api
@@ -0,0 +1,398 @@
+import asyncio
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+from tests.conftest import Thing, benchmark
+from visma.api import (VismaAPI, AsyncVismaAPI, VismaAPIException,
+                       RetryPolicy, RateLimiter)
+from visma.cache import ResponseCache
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and body without waiting for delayed ACKs on
+    # kept alive connections.
+    disable_nagle_algorithm = True
+    connections = set()
+    # Status codes to respond with before responding 200.
+    failures = []
+    # Seconds to wait before responding to requests.
+    delays = []
+    requests = []
+    body = {'Data': [], 'Meta': {}}
+
+    def respond(self):
+        self.connections.add(self.client_address)
+        self.requests.append((self.command, self.path))
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/token':
+            status = 200
+            body = json.dumps({'access_token': 'new-access',
+                               'refresh_token': 'new-refresh',
+                               'expires_in': 3600}).encode()
+        else:
+            if self.delays:
+                time.sleep(self.delays.pop(0))
+            status = self.failures.pop(0) if self.failures else 200
+            body = json.dumps(self.body).encode()
+        if status == 200 and self.headers.get('If-None-Match') == '"v1"':
+            status = 304
+            body = b''
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        if self.command == 'GET':
+            self.send_header('ETag', '"v1"')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in_server():
+    StandInHandler.connections = set()
+    StandInHandler.failures = []
+    StandInHandler.delays = []
+    StandInHandler.requests = []
+    StandInHandler.body = {'Data': [], 'Meta': {}}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_api(**kwargs):
+    expires = (datetime.datetime.now(tz=datetime.timezone.utc) +
+               datetime.timedelta(hours=1))
+    return VismaAPI('client', 'secret', access_token='access',
+                    refresh_token='refresh', token_expires=expires, **kwargs)
+
+
+def test_session_is_reused():
+    api = make_api(pool_maxsize=4)
+    assert api.session is api.session
+    adapter = api.session.get_adapter('https://')
+    assert adapter._pool_maxsize == 4
+
+
+def test_idle_session_is_replaced():
+    api = make_api(pool_idle_timeout=0.001)
+    session = api.session
+    api._session_last_used -= 1
+    assert api.session is not session
+
+
+def test_connections_are_kept_alive(stand_in_server):
+    api = make_api()
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+
+    for _ in range(5):
+        api.get('/customers')
+
+    assert len(StandInHandler.connections) == 1
+
+
+@benchmark
+def test_benchmark_connection_reuse(stand_in_server):
+    api = make_api()
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+    url = api.API_URL + '/customers'
+    n = 500
+
+    start = time.perf_counter()
+    for _ in range(n):
+        requests.get(url, headers=api.api_headers)
+    without_reuse = (time.perf_counter() - start) / n
+
+    start = time.perf_counter()
+    for _ in range(n):
+        api.get('/customers')
+    with_reuse = (time.perf_counter() - start) / n
+
+    print(f'\nRequest latency without connection reuse '
+          f'{without_reuse * 1000:.3f} ms, with reuse '
+          f'{with_reuse * 1000:.3f} ms')
+    assert len(StandInHandler.connections) == n + 1
+    assert with_reuse < without_reuse
+
+
+def test_retry_on_throttling(stand_in_server):
+    api = make_api(retry_policy=RetryPolicy(backoff_factor=0))
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+    StandInHandler.failures = [429, 503]
+
+    api.get('/customers')
+
+    assert len(StandInHandler.requests) == 3
+    assert api.retry_policy.retries == 2
+
+
+def test_post_is_not_retried_by_default(stand_in_server):
+    api = make_api(retry_policy=RetryPolicy(backoff_factor=0))
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+    StandInHandler.failures = [503]
+
+    with pytest.raises(VismaAPIException):
+        api.post('/customers', '{}')
+
+    assert len(StandInHandler.requests) == 1
+
+
+def test_adaptive_page_size_shrinks_on_timeout(stand_in_server):
+    api = make_api(adaptive_page_size=True, timeout=0.2,
+                   retry_policy=RetryPolicy(backoff_factor=0))
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+    StandInHandler.delays = [1]
+    StandInHandler.body = {
+        'Data': [], 'Meta': {'CurrentPage': 1, 'PageSize': 50,
+                             'TotalNumberOfPages': 0,
+                             'TotalNumberOfResults': 0,
+                             'ServerTimeUtc': '2018-06-21T16:23:13Z'}}
+
+    list(Thing.objects.using(api).all())
+
+    page_sizes = [parse_qs(urlsplit(path).query)['$pagesize']
+                  for _, path in StandInHandler.requests]
+    assert page_sizes == [['50'], ['25']]
+    assert api.retry_policy.retries == 0
+    assert api.page_sizers['/things'].history[0] == (50, None, None)
+
+
+def test_retry_budget():
+    policy = RetryPolicy(retry_budget=1, retry_budget_window=60)
+
+    assert policy.should_retry('GET', 0)
+    assert not policy.should_retry('GET', 0)
+
+    # The budget is refilled over the window.
+    policy._budget_updated -= 30
+    assert not policy.should_retry('GET', 0)
+    policy._budget_updated -= 30
+    assert policy.should_retry('GET', 0)
+    assert policy.retries == 2
+
+
+def test_long_retry_after_is_not_waited_for():
+    policy = RetryPolicy(max_retry_after=120)
+    response = requests.Response()
+    response.status_code = 429
+
+    response.headers['Retry-After'] = '60'
+    assert policy.should_retry('GET', 0, response)
+    assert policy.get_backoff(0, response) == 60
+
+    response.headers['Retry-After'] = '86400'
+    assert not policy.should_retry('GET', 0, response)
+
+
+def test_rate_limiter_is_shared_per_tenant():
+    api = make_api(tenant='company', rate_limit=5)
+    other_api = make_api(tenant='company', rate_limit=5)
+
+    assert api.rate_limiter is other_api.rate_limiter
+    assert make_api(tenant='other', rate_limit=5).rate_limiter is not (
+        api.rate_limiter)
+
+
+def test_rate_limiter_waits_when_bucket_is_empty():
+    rate_limiter = RateLimiter(rate=1000, burst=2)
+
+    for _ in range(4):
+        rate_limiter.acquire()
+
+    assert rate_limiter.requests == 4
+    assert rate_limiter.waits == 2
+    assert rate_limiter.wait_time > 0
+
+
+def test_async_api(stand_in_server):
+    expires = (datetime.datetime.now(tz=datetime.timezone.utc) +
+               datetime.timedelta(hours=1))
+
+    async def run():
+        async with AsyncVismaAPI('client', 'secret', access_token='access',
+                                 refresh_token='refresh',
+                                 token_expires=expires) as api:
+            api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+            responses = await asyncio.gather(
+                *[api.get('/customers') for _ in range(5)])
+        return responses
+
+    responses = asyncio.run(run())
+
+    assert all(response.json() == {'Data': [], 'Meta': {}}
+               for response in responses)
+    assert len(StandInHandler.requests) == 5
+
+
+def test_unauthorized_request_is_replayed_with_new_token(stand_in_server):
+    api = make_api()
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+    api.TOKEN_URL = api.API_URL + '/token'
+    StandInHandler.failures = [401]
+
+    api.get('/customers')
+
+    assert StandInHandler.requests == [('GET', '/customers'),
+                                       ('POST', '/token'),
+                                       ('GET', '/customers')]
+    assert api.access_token == 'new-access'
+
+
+def test_token_is_refreshed_once_by_concurrent_threads(stand_in_server,
+                                                       tmp_path):
+    token_path = tmp_path / 'tokens.json'
+    api = make_api(token_path=str(token_path))
+    api._save_tokens()
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+    api.TOKEN_URL = api.API_URL + '/token'
+    api.token_expires = datetime.datetime.now(tz=datetime.timezone.utc)
+    api._save_tokens()
+
+    threads = [threading.Thread(target=api.get, args=('/customers',))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert StandInHandler.requests.count(('POST', '/token')) == 1
+    assert json.loads(token_path.read_text())['access_token'] == 'new-access'
+
+
+def test_token_file_is_created_on_refresh(stand_in_server, tmp_path):
+    token_path = tmp_path / 'tokens.json'
+
+    class StandInAPI(VismaAPI):
+        TOKEN_URL = 'http://%s:%s/token' % stand_in_server.server_address
+
+    expired = datetime.datetime.now(tz=datetime.timezone.utc)
+    api = StandInAPI('client', 'secret', access_token='access',
+                     refresh_token='refresh', token_expires=expired,
+                     token_path=str(token_path))
+
+    assert api.access_token == 'new-access'
+    assert json.loads(token_path.read_text())['access_token'] == 'new-access'
+
+
+def test_responses_are_cached_on_disk(stand_in_server, tmp_path):
+    cache_path = str(tmp_path / 'responses.db')
+    api = make_api(response_cache=ResponseCache(cache_path))
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+
+    api.get('/customers', params={'$page': 1})
+    # Another process using the same cache file.
+    other_api = make_api(response_cache=ResponseCache(cache_path))
+    other_api.API_URL = api.API_URL
+    response = other_api.get('/customers', params={'$page': 1})
+
+    assert response.json() == {'Data': [], 'Meta': {}}
+    assert len(StandInHandler.requests) == 1
+
+    # Other parameters and tenants are cached separately.
+    api.get('/customers', params={'$page': 2})
+    other_tenant_api = make_api(tenant='other',
+                                response_cache=api.response_cache)
+    other_tenant_api.API_URL = api.API_URL
+    other_tenant_api.get('/customers', params={'$page': 1})
+    assert len(StandInHandler.requests) == 3
+
+    # Writes to the resource remove its cached responses.
+    api.post('/customers/1', '{}')
+    api.get('/customers', params={'$page': 1})
+    assert len(StandInHandler.requests) == 5
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.db'), max_size=10,
+                          endpoints={'/vatcodes': 60})
+
+    cache.set('company', '/vatcodes', {'$page': 1}, 200, {}, b'12345')
+    cache.set('company', '/vatcodes', {'$page': 2}, 200, {}, b'12345')
+    cache.get('company', '/vatcodes', {'$page': 1})
+    cache.set('company', '/vatcodes', {'$page': 3}, 200, {}, b'12345')
+    cache.set('company', '/customers', None, 200, {}, b'12345')
+
+    assert cache.get('company', '/vatcodes', {'$page': 1}) is not None
+    assert cache.get('company', '/vatcodes', {'$page': 2}) is None
+    assert cache.get('company', '/customers') is None
+    assert cache.evictions == 1
+
+
+def test_conditional_get(stand_in_server):
+    api = make_api(conditional_requests=True)
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+
+    first = api.get('/vatcodes')
+    second = api.get('/vatcodes')
+
+    assert second.status_code == 200
+    assert second.json() == first.json()
+    assert len(StandInHandler.requests) == 2
+    assert api.response_cache.revalidations == 1
+
+
+def test_revalidated_response_is_not_decoded_again(stand_in_server,
+                                                    monkeypatch):
+    api = make_api(conditional_requests=True)
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+    StandInHandler.body = {
+        'Id': 1, 'Name': 'Thing 1',
+        'Data': [{'Id': 1, 'Name': 'Thing 1'}],
+        'Meta': {'CurrentPage': 1, 'PageSize': 50, 'TotalNumberOfPages': 1,
+                 'TotalNumberOfResults': 1,
+                 'ServerTimeUtc': '2018-06-21T16:23:13Z'}}
+    objects = Thing.objects.using(api)
+    decoded = []
+    json_ = requests.Response.json
+    monkeypatch.setattr(requests.Response, 'json',
+                        lambda self: decoded.append(self) or json_(self))
+
+    polls = [(list(objects.all()), objects.get(1)) for _ in range(3)]
+
+    assert len(StandInHandler.requests) == 6
+    assert api.response_cache.revalidations == 4
+    # Decoded from the 200 responses and the first 304 of each URL only.
+    assert len(decoded) == 4
+
+    # Every request gets new objects, so edits don't leak between them.
+    thing = polls[2][1]
+    thing.name = 'Edited'
+    listed = polls[2][0][0]
+    listed.name = 'Edited'
+    assert objects.get(1) is not thing
+    assert objects.get(1).name == 'Thing 1'
+    assert objects.get(1).changed_fields == set()
+    assert list(objects.all())[0].name == 'Thing 1'
+
+
+def test_expired_response_is_revalidated(stand_in_server, tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.db'), ttl=0)
+    api = make_api(response_cache=cache)
+    api.API_URL = 'http://%s:%s' % stand_in_server.server_address
+
+    api.get('/vatcodes')
+    response = api.get('/vatcodes')
+
+    assert response.json() == {'Data': [], 'Meta': {}}
+    assert len(StandInHandler.requests) == 2
+    assert cache.revalidations == 1
@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+import visma
+from visma.clients import unregister_client, DEFAULT_CLIENT
+from visma.models import Customer, Article
+from tests.conftest import FakeAPI
+
+
+@pytest.fixture
+def default_client():
+    original_client = visma.get_client()
+    client = visma.register_client(FakeAPI([]))
+    yield client
+    visma.register_client(original_client)
+
+
+def test_managers_share_default_client(default_client):
+    assert Customer.objects.api is default_client
+    assert Article.objects.api is default_client
+
+
+def test_tenant_binds_client(default_client):
+    acme = FakeAPI([])
+    visma.register_client(acme, name='acme')
+    seen_in_thread = []
+
+    with visma.tenant('acme') as client:
+        assert client is acme
+        assert Customer.objects.api is acme
+        assert Customer.objects.all().api is acme
+
+        thread = threading.Thread(
+            target=lambda: seen_in_thread.append(Customer.objects.api))
+        thread.start()
+        thread.join()
+
+    assert Customer.objects.api is default_client
+    assert seen_in_thread == [default_client]
+    unregister_client('acme')
+
+    with pytest.raises(KeyError):
+        visma.get_client('acme')
+
+
+def test_default_client_is_loaded_once():
+    original_client = unregister_client(DEFAULT_CLIENT)
+    try:
+        assert visma.get_client() is visma.get_client()
+    finally:
+        visma.register_client(original_client)
+
+
+class ClosingAPI(FakeAPI):
+
+    def __init__(self, name):
+        super().__init__([{'Id': 1, 'Name': name}])
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_using_client():
+    from tests.conftest import Thing
+
+    acme = ClosingAPI('acme')
+    other = ClosingAPI('other')
+
+    with visma.tenant(other):
+        assert Thing.objects.using(acme).api is acme
+        assert [thing.name for thing in Thing.objects.using(acme).all()] == [
+            'acme']
+        assert [thing.name for thing in
+                Thing.objects.all().using(acme)] == ['acme']
+        assert Thing.objects.api is other
+
+
+def test_tenant_pool_keeps_recently_used_clients():
+    pool = visma.TenantPool(ClosingAPI, max_size=2)
+
+    acme = pool.get('acme')
+    assert pool.get('acme') is acme
+    pool.get('globex')
+    pool.get('acme')
+    initech = pool.get('initech')
+
+    # globex was the least recently used.
+    assert 'globex' not in pool
+    assert len(pool) == 2
+    assert not acme.closed
+    assert (pool.hits, pool.misses, pool.evictions) == (2, 3, 1)
+
+    with pool.tenant('initech'):
+        assert Customer.objects.api is initech
+
+    pool.clear()
+    assert acme.closed and initech.closed
+    assert len(pool) == 0
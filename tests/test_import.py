@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+# Budget for importing visma.models once its dependencies are imported,
+# counting the standard library modules it loads. About twice the 28-30 ms
+# it takes, also without a __pycache__.
+IMPORT_TIME_BUDGET_US = 60000
+IMPORT_DEPENDENCIES = 'import iso8601, marshmallow, requests\n'
+
+
+def run_python(code, **env):
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True,
+                          env=dict(os.environ, **env))
+
+
+def test_import_models_within_budget():
+    result = run_python(IMPORT_DEPENDENCIES + 'import visma.models')
+    assert result.returncode == 0, result.stderr
+
+    cumulative_time = None
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        if module.strip() == 'visma.models':
+            cumulative_time = int(cumulative)
+
+    assert 0 < cumulative_time < IMPORT_TIME_BUDGET_US
+
+
+def test_optional_modules_are_imported_when_used():
+    code = ('import sys\n'
+            'import visma.models\n'
+            'modules = ("asyncio", "httpx", "sqlite3", "concurrent.futures")\n'
+            'print([name for name in modules if name in sys.modules])')
+    result = run_python(code)
+
+    assert result.stdout == '[]\n', result.stderr
+
+
+def test_api_is_loaded_on_first_manager_use():
+    code = ('from visma.models import Customer\n'
+            'print(\'imported\')\n'
+            'Customer.objects.api\n')
+    result = run_python(code, VISMA_API_CLASS='visma.no_such_module.API')
+
+    # The import succeeds and the API class is only imported when used.
+    assert result.stdout == 'imported\n'
+    assert 'No module named' in result.stderr
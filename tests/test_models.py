@@ -1,4 +1,18 @@
-from visma.models import TermsOfPayment, CustomerInvoiceDraft
+import copy
+import sys
+import time
+import tracemalloc
+import uuid
+
+import pytest
+from marshmallow import fields
+from marshmallow.exceptions import RegistryError
+
+from tests.conftest import FakeAPI, Thing, benchmark
+from visma.api import VismaAPIException
+from visma.base import VismaModel
+from visma.models import (TermsOfPayment, Customer, CustomerInvoiceDraft,
+                          Article, CostCenter)
 
 
 def test_customer_model_has_manager():
@@ -25,4 +39,282 @@ def test_model_endpoint():
 
 
 
-# TODO: test allowed methods. But how to do it without API access? Maybe need to mock the api?
\ No newline at end of file
+# TODO: test allowed methods. But how to do it without API access? Maybe need to mock the api?
+
+def test_model_instances_share_field_objects():
+    thing = Thing(name='thing')
+
+    assert 'schema_fields' not in vars(thing)
+    assert thing.id is None
+    assert thing.name == 'thing'
+
+
+def test_slotted_model():
+    class SlottedThing(VismaModel):
+        id = fields.Integer(data_key='Id', allow_none=True)
+        name = fields.String(data_key='Name', allow_none=True)
+
+        class Meta:
+            slots = True
+
+    thing = SlottedThing(name='thing')
+    assert not hasattr(thing, '__dict__')
+    assert SlottedThing.__slots__ == ('id', 'name', '_changed_fields',
+                                     '_client')
+
+    thing._update_value(SlottedThing(id=1, name='other'))
+    assert (thing.id, thing.name) == (1, 'other')
+
+    loaded = SlottedThing._schema_klass().load({'Id': 2, 'Name': 'loaded'})
+    assert (loaded.id, loaded.name) == (2, 'loaded')
+
+
+def test_fast_path_matches_marshmallow():
+    data = {'Id': 'e530798a-5821-4112-bc84-d2bc725772ee',
+            'Name': 'Projects',
+            'Number': 1,
+            'IsActive': True,
+            'Items': [{'Id': 'b7a9c51d-2ddb-4ff4-8b41-3f7a1b0b2c0a',
+                       'CostCenterId': 'e530798a-5821-4112-bc84-d2bc725772ee',
+                       'Name': 'Project 1',
+                       'ShortName': 'P1',
+                       'IsActive': True}]}
+    schema = CostCenter._schema_klass()
+
+    loaded = schema.load(data)
+    fast_loaded = schema.fast_load(data)
+
+    assert fast_loaded.id == loaded.id
+    assert fast_loaded.items[0].cost_center_id == loaded.items[0].cost_center_id
+    assert schema.fast_dump(fast_loaded) == schema.dump(loaded)
+
+
+def test_nested_fields_are_loaded_lazily():
+    data = {'Id': 'e530798a-5821-4112-bc84-d2bc725772ee',
+            'Name': 'Projects',
+            'Number': 1,
+            'IsActive': True,
+            'Items': [{'Id': 'b7a9c51d-2ddb-4ff4-8b41-3f7a1b0b2c0a',
+                       'CostCenterId': 'e530798a-5821-4112-bc84-d2bc725772ee',
+                       'Name': 'Project 1',
+                       'ShortName': 'P1',
+                       'IsActive': True}]}
+    schema = CostCenter._schema_klass()
+
+    cost_center = schema.fast_load(data)
+    assert 'items' in CostCenter._lazy_fields
+    assert cost_center._nested_values['items'].data == data['Items']
+
+    items = cost_center.items
+    assert items[0].name == 'Project 1'
+    assert cost_center.items is items
+    assert schema.fast_dump(cost_center)['Items'][0]['ShortName'] == 'P1'
+
+    cost_center.items = []
+    assert cost_center.items == []
+
+
+def test_save_sends_changed_fields_only(fake_api):
+    thing = Thing.objects.get(3)
+    assert thing.changed_fields == set()
+
+    thing.save()
+    assert fake_api.sent == []
+    assert Thing.objects.skipped_updates == 1
+
+    thing.name = 'Renamed'
+    assert thing.changed_fields == {'name'}
+    thing.save()
+    assert fake_api.sent == [{'Name': 'Renamed'}]
+    assert thing.changed_fields == set()
+    assert Thing.objects.payload_bytes == len('{"Name": "Renamed"}')
+
+    thing.save(update_fields=['id', 'name'])
+    assert fake_api.sent[-1] == {'Id': 3, 'Name': 'Renamed'}
+
+    with pytest.raises(ValueError):
+        thing.save(update_fields=['colour'])
+
+
+def test_save_uses_the_loading_client(fake_api):
+    acme = FakeAPI([{'Id': i, 'Name': f'Acme {i}'} for i in range(5)])
+
+    thing = Thing.objects.using(acme).get(0)
+    thing.name = 'Renamed'
+    thing.save()
+    thing.delete()
+
+    assert acme.sent == [{'Name': 'Renamed'}]
+    assert acme.rows[0] is None
+    assert fake_api.sent == []
+    assert fake_api.rows[0] is not None
+
+
+def test_nested_changes_in_place_are_detected():
+    data = {'Id': 'e530798a-5821-4112-bc84-d2bc725772ee',
+            'Name': 'Projects',
+            'Number': 1,
+            'IsActive': True,
+            'Items': [{'Id': 'b7a9c51d-2ddb-4ff4-8b41-3f7a1b0b2c0a',
+                       'CostCenterId': 'e530798a-5821-4112-bc84-d2bc725772ee',
+                       'Name': 'Project 1',
+                       'ShortName': 'P1',
+                       'IsActive': True}]}
+    cost_center = CostCenter._schema_klass().fast_load(data)
+
+    assert cost_center.items[0].name == 'Project 1'
+    assert cost_center.changed_fields == set()
+
+    cost_center.items[0].name = 'Project 2'
+    assert cost_center.changed_fields == {'items'}
+
+
+def test_bulk_create_update_and_delete(fake_api):
+    things = [Thing(name=f'New {i}') for i in range(10)]
+    results = Thing.objects.bulk_create(things, concurrency=3)
+
+    assert all(result.ok for result in results)
+    assert [result.obj for result in results] == things
+    assert sorted(thing.id for thing in things) == list(range(120, 130))
+    assert all(thing.changed_fields == set() for thing in things)
+
+    things[0].name = 'Renamed'
+    missing = Thing(id=500, name='Missing')
+    results = Thing.objects.bulk_update(things[:2] + [missing])
+
+    assert results[0].ok and results[0].result.name == 'Renamed'
+    assert results[1].ok and results[1].result is None
+    assert isinstance(results[2].error, VismaAPIException)
+    assert fake_api.rows[things[0].id]['Name'] == 'Renamed'
+
+    results = Thing.objects.bulk_delete([things[0], things[1].id, 500])
+    assert [result.ok for result in results] == [True, True, False]
+    assert fake_api.rows[things[0].id] is None
+
+
+def make_data(model, rows=5):
+    """
+    JSON for model with a value for every field and rows items in lists.
+    """
+    data = dict()
+    for field_name, field in model._schema_items.items():
+        if field.dump_only:
+            continue
+        try:
+            data[field.data_key or field_name] = make_value(field, rows)
+        except RegistryError:
+            # Nested models that aren't implemented yet are left out.
+            pass
+    return data
+
+
+def make_value(field, rows):
+    if isinstance(field, fields.Nested):
+        value = make_data(field.schema.visma_model, rows)
+        return [value] * rows if field.many else value
+    if isinstance(field, fields.List):
+        return [make_value(field.container, rows)] * rows
+    if isinstance(field, fields.UUID):
+        return str(uuid.uuid4())
+    if isinstance(field, fields.Boolean):
+        return True
+    if isinstance(field, fields.Integer):
+        return 1
+    if isinstance(field, fields.Number):
+        return 0.5
+    if isinstance(field, fields.DateTime):
+        return '2020-01-01T12:00:00Z'
+    if isinstance(field, fields.Date):
+        return '2020-01-01'
+    return 'SE'
+
+
+def objects_per_second(load, data, n=500):
+    start = time.perf_counter()
+    for _ in range(n):
+        load(data)
+    return n / (time.perf_counter() - start)
+
+
+@benchmark
+@pytest.mark.parametrize('model', [Customer, CustomerInvoiceDraft])
+def test_benchmark_model_init(model, monkeypatch):
+    schema = model._schema_klass()
+    data = make_data(model)
+    shared = objects_per_second(schema.load, data)
+
+    # Deep copy the field objects for every instance, as before they were
+    # shared.
+    init = VismaModel.__init__
+
+    def deepcopy_init(self, *args, **kwargs):
+        self.schema_fields = copy.deepcopy(self._schema_items)
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(VismaModel, '__init__', deepcopy_init)
+    deep_copied = objects_per_second(schema.load, data)
+
+    print(f'\n{model.__name__} loads with shared fields {shared:.0f}/s, '
+          f'with deep copied fields {deep_copied:.0f}/s')
+    assert shared > deep_copied
+
+
+def bytes_per_object(load, data, n=10000):
+    tracemalloc.start()
+    try:
+        objs = [load(data) for _ in range(n)]
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(objs) == n
+    return size / n
+
+
+@benchmark
+def test_benchmark_slotted_model_size():
+    data = make_data(Article)
+    sizes = dict()
+    instance_sizes = dict()
+    for slots in (False, True):
+        attrs = copy.deepcopy(Article._schema_items)
+        attrs['Meta'] = type('Meta', (), {'slots': slots})
+        model = type(f'ArticleSlots{slots}', (VismaModel,), attrs)
+        load = model._schema_klass().fast_load
+        sizes[slots] = bytes_per_object(load, data)
+        # The instance itself, without the field values.
+        obj = load(data)
+        instance_sizes[slots] = sys.getsizeof(obj)
+        if hasattr(obj, '__dict__'):
+            instance_sizes[slots] += sys.getsizeof(obj.__dict__)
+
+    print(f'\nArticle instance without slots {instance_sizes[False]} bytes, '
+          f'with slots {instance_sizes[True]} bytes. Including values '
+          f'{sizes[False]:.0f} and {sizes[True]:.0f} bytes')
+    assert instance_sizes[True] < instance_sizes[False]
+    assert sizes[True] < sizes[False]
+
+
+@benchmark
+@pytest.mark.parametrize('model', [Customer, CustomerInvoiceDraft])
+def test_benchmark_fast_path(model):
+    schema = model._schema_klass()
+    data = make_data(model)
+
+    def fast_load(data):
+        obj = schema.fast_load(data)
+        # Convert the lazy nested fields too, as marshmallow does.
+        for field_name in model._lazy_fields:
+            getattr(obj, field_name)
+        return obj
+
+    loads = objects_per_second(schema.load, data)
+    fast_loads = objects_per_second(fast_load, data)
+    obj = schema.load(data)
+    dumps = objects_per_second(schema.dump, obj)
+    fast_dumps = objects_per_second(schema.fast_dump, obj)
+
+    print(f'\n{model.__name__} marshmallow {loads:.0f} loads/s, '
+          f'{dumps:.0f} dumps/s. Fast path {fast_loads:.0f} loads/s, '
+          f'{fast_dumps:.0f} dumps/s')
+    assert fast_loads > loads
+    assert fast_dumps > dumps
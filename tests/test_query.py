@@ -0,0 +1,539 @@
+import asyncio
+import datetime
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+from marshmallow import fields
+
+from visma.api import VismaAPIException
+from visma.base import VismaModel
+from visma.models import PaginatedResponse
+from visma.sync import WatermarkStore
+from tests.conftest import (AsyncFakeAPI, FakeAPI, FakeResponse, Thing,
+                            benchmark)
+
+
+class Owner(VismaModel):
+    id = fields.Integer(data_key='Id', allow_none=True)
+    name = fields.String(data_key='Name', allow_none=True)
+
+    class Meta:
+        endpoint = '/owners'
+        allowed_methods = ['list', 'get']
+        envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+
+
+class Toy(VismaModel):
+    maker_id = fields.Integer(data_key='MakerId', allow_none=True)
+
+    class Meta:
+        related = {'maker': ('maker_id', 'Owner')}
+
+
+class Vet(VismaModel):
+    id = fields.Integer(data_key='Id', allow_none=True)
+    name = fields.String(data_key='Name', allow_none=True)
+
+    class Meta:
+        # Can't be listed, so prefetching gets them one at a time.
+        endpoint = '/vets'
+        allowed_methods = ['get']
+
+
+class Pet(VismaModel):
+    id = fields.Integer(data_key='Id', allow_none=True)
+    owner_id = fields.Integer(data_key='OwnerId', allow_none=True)
+    vet_id = fields.Integer(data_key='VetId', allow_none=True)
+    toys = fields.List(fields.Nested('ToySchema'), data_key='Toys',
+                       allow_none=True)
+
+    class Meta:
+        endpoint = '/pets'
+        allowed_methods = ['list', 'get']
+        envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+        related = {'owner': ('owner_id', 'Owner'),
+                   'vet': ('vet_id', 'Vet')}
+
+
+class PetsAPI(FakeAPI):
+    """
+    Serves pets, their owners and vets, and the Id filters used by
+    prefetching.
+    """
+
+    def __init__(self):
+        super().__init__([{'Id': i, 'OwnerId': i % 5, 'VetId': i % 4,
+                           'Toys': [{'MakerId': 10 + i % 3}]}
+                          for i in range(60)])
+        self.owners = [{'Id': i, 'Name': f'Owner {i}'} for i in range(20)]
+        self.vets = [{'Id': i, 'Name': f'Vet {i}'} for i in range(3)]
+        self.get_calls = []
+
+    def get(self, endpoint, params=None, **kwargs):
+        name, _, pk = endpoint.strip('/').partition('/')
+        if not pk:
+            return super().get(endpoint, params=params, **kwargs)
+        self.get_calls.append(endpoint)
+        rows = {'pets': self.rows, 'owners': self.owners,
+                'vets': self.vets}[name]
+        if int(pk) >= len(rows):
+            raise VismaAPIException(f'HTTP:404, {endpoint}')
+        return FakeResponse(rows[int(pk)])
+
+    def get_rows(self, endpoint, params):
+        if endpoint != '/owners':
+            return self.rows
+        ids = {int(pk) for pk in re.findall(r'Id eq (\d+)',
+                                            params.get('$filter', ''))}
+        return [row for row in self.owners if row['Id'] in ids]
+
+
+class AsyncPetsAPI(PetsAPI):
+
+    async def get(self, endpoint, params=None, **kwargs):
+        return super().get(endpoint, params=params, **kwargs)
+
+
+def test_pages_are_fetched_in_order(fake_api):
+    things = list(Thing.objects.all())
+
+    assert [thing.id for thing in things] == list(range(120))
+    assert [call['$page'] for call in fake_api.calls] == [1, 2, 3]
+
+
+def test_concurrent_pages_are_yielded_in_order(fake_api):
+    fake_api.max_concurrent_pages = 4
+
+    things = list(Thing.objects.all())
+
+    assert [thing.id for thing in things] == list(range(120))
+    assert sorted(call['$page'] for call in fake_api.calls) == [1, 2, 3]
+
+
+def test_exclude_quotes_strings(fake_api):
+    list(Thing.objects.exclude(name__in=['a', 'b']))
+    assert fake_api.calls[-1]['$filter'] == "(Name ne 'a' and Name ne 'b')"
+
+    list(Thing.objects.exclude(id__in=[1, 2]).exclude(name='a'))
+    assert fake_api.calls[-1]['$filter'] == (
+        "(Id ne 1 and Id ne 2) and Name ne 'a'")
+
+
+def test_iterator_streams_without_filling_cache(fake_api):
+    queryset = Thing.objects.all()
+    iterator = queryset.iterator(chunk_size=100)
+
+    first = next(iterator)
+
+    assert first.id == 0
+    assert len(fake_api.calls) == 1
+    assert fake_api.calls[0]['$pagesize'] == 100
+    assert [thing.id for thing in iterator] == list(range(1, 120))
+    assert queryset._result_cache is None
+
+
+# Lists or streams 100k things from a FakeAPI generating the rows on demand,
+# and prints the seconds to the first object and its peak memory.
+ITERATION_BENCHMARK = """
+import sys, time, tracemalloc
+from tests.conftest import FakeAPI, Thing
+
+class Rows:
+    def __len__(self):
+        return 100000
+
+    def __getitem__(self, index):
+        return [{'Id': i, 'Name': f'Thing {i}'}
+                for i in range(*index.indices(len(self)))]
+
+def objects():
+    queryset = Thing.objects.using(FakeAPI(Rows())).all().page_size(1000)
+    if sys.argv[1] == 'iterator':
+        return queryset.iterator()
+    return iter(queryset)
+
+start = time.perf_counter()
+next(objects())
+first = time.perf_counter() - start
+
+# ru_maxrss would include the memory of the parent process on Linux, so
+# the peak is traced separately from the timing above.
+tracemalloc.start()
+for obj in objects():
+    pass
+print(first, tracemalloc.get_traced_memory()[1])
+"""
+
+
+@benchmark
+def test_benchmark_iterator():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = dict()
+    for mode in ('list', 'iterator'):
+        result = subprocess.run(
+            [sys.executable, '-c', ITERATION_BENCHMARK, mode],
+            capture_output=True, text=True, cwd=root, check=True)
+        first, peak = result.stdout.split()
+        results[mode] = (float(first), int(peak))
+        print(f'\n{mode}: first object after {float(first) * 1000:.1f} ms, '
+              f'peak memory {int(peak) / 1024 / 1024:.1f} MB')
+
+    assert results['iterator'][0] < results['list'][0]
+    assert results['iterator'][1] < results['list'][1]
+
+
+def test_slice_fetches_one_page(fake_api):
+    things = Thing.objects.all()[:10]
+
+    assert [thing.id for thing in things] == list(range(10))
+    assert fake_api.calls == [{'$pagesize': 10, '$page': 1}]
+
+
+def test_slice_with_unaligned_offset(fake_api):
+    things = Thing.objects.all()[7:17]
+
+    assert [thing.id for thing in things] == list(range(7, 17))
+    assert len(fake_api.calls) == 1
+
+
+def test_open_ended_slice(fake_api):
+    things = Thing.objects.all()[55:]
+
+    assert [thing.id for thing in things] == list(range(55, 120))
+    assert [call['$page'] for call in fake_api.calls] == [2, 3]
+
+
+def test_index_and_first(fake_api):
+    assert Thing.objects.all()[42].id == 42
+    assert Thing.objects.all().first().id == 0
+    assert [call['$pagesize'] for call in fake_api.calls] == [1, 1]
+
+
+def test_count_and_exists_make_one_row_requests(fake_api):
+    queryset = Thing.objects.all()
+
+    assert queryset.count() == 120
+    assert len(queryset) == 120
+    assert queryset.exists()
+    assert all(call['$pagesize'] == 1 for call in fake_api.calls)
+    assert len(fake_api.calls) == 1
+
+
+def test_page_size_on_queryset_and_api(fake_api):
+    list(Thing.objects.all().page_size(60))
+    assert [call['$pagesize'] for call in fake_api.calls] == [60, 60]
+
+    fake_api.calls = []
+    fake_api.page_size = 100
+    list(Thing.objects.all())
+    assert [call['$pagesize'] for call in fake_api.calls] == [100, 100]
+
+
+def test_adaptive_page_size_grows_and_shrinks(fake_api):
+    fake_api.adaptive_page_size = True
+    fake_api.page_size = 10
+
+    things = list(Thing.objects.all())
+
+    assert [thing.id for thing in things] == list(range(120))
+    assert [call['$pagesize'] for call in fake_api.calls] == [10, 10, 20, 40,
+                                                              80]
+
+    fake_api.calls = []
+    fake_api.max_timeout_page_size = 100
+    things = list(Thing.objects.all())
+
+    assert [thing.id for thing in things] == list(range(120))
+    assert [call['$pagesize'] for call in fake_api.calls] == [160, 80, 80]
+    sizes = [size for size, _, _ in fake_api.page_sizers['/things'].history]
+    assert sizes[-3:] == [160, 80, 80]
+
+
+def test_async_queryset(async_fake_api):
+    async_fake_api.max_concurrent_pages = 2
+
+    async def run():
+        queryset = Thing.objects.all()
+        things = [thing async for thing in queryset]
+        return things, await queryset.acount(), await queryset.afirst()
+
+    things, count, first = asyncio.run(run())
+
+    assert [thing.id for thing in things] == list(range(120))
+    assert count == 120
+    assert first.id == 0
+
+
+def test_values_skip_model_instantiation(fake_api):
+    queryset = Thing.objects.all()
+
+    assert queryset.values('name')[:2] == [{'name': 'Thing 0'},
+                                           {'name': 'Thing 1'}]
+    assert queryset.values()[0] == {'id': 0, 'name': 'Thing 0'}
+    assert queryset.values_list('id', 'name')[5] == (5, 'Thing 5')
+    assert list(queryset.values_list('id', flat=True)) == list(range(120))
+    assert queryset.raw()[3] == {'Id': 3, 'Name': 'Thing 3'}
+
+
+def test_prefetch_related():
+    api = PetsAPI()
+    pets = Pet.objects.using(api).all().prefetch_related('owner',
+                                                         'toys__maker')
+    result = list(pets)
+
+    # 2 pages of pets and one request each for the owners and the toy
+    # makers. All are found on the first page so none on the second.
+    assert len(api.calls) == 4
+    assert api.calls[1]['$filter'] == (
+        '(Id eq 0 or Id eq 1 or Id eq 2 or Id eq 3 or Id eq 4)')
+    assert pets.prefetch_requests == 2
+    assert pets.prefetch_requests_saved == 120 - 2
+
+    assert result[7].owner.name == 'Owner 2'
+    assert result[7].toys[0].maker.name == 'Owner 11'
+    assert len(api.calls) == 4
+
+
+
+def test_prefetch_related_gets_models_that_cant_be_listed():
+    api = PetsAPI()
+    pets = Pet.objects.using(api).all().prefetch_related('vet')
+    result = list(pets)
+
+    assert sorted(api.get_calls) == ['/vets/0', '/vets/1', '/vets/2',
+                                     '/vets/3']
+    assert pets.prefetch_requests == 4
+    assert result[5].vet.name == 'Vet 1'
+    assert result[3].vet is None
+    assert len(api.get_calls) == 4
+
+
+def test_async_prefetch_related():
+    api = AsyncPetsAPI()
+    pets = Pet.objects.using(api).all().prefetch_related('owner', 'vet',
+                                                         'toys__maker')
+
+    async def run():
+        return [pet async for pet in pets]
+
+    result = asyncio.run(run())
+
+    assert pets.prefetch_requests == 2 + 4
+    assert sorted(api.get_calls) == ['/vets/0', '/vets/1', '/vets/2',
+                                     '/vets/3']
+    calls = len(api.calls)
+    assert result[7].owner.name == 'Owner 2'
+    assert result[5].vet.name == 'Vet 1'
+    assert result[3].vet is None
+    assert result[7].toys[0].maker.name == 'Owner 11'
+    assert len(api.calls) == calls
+    assert len(api.get_calls) == 4
+
+
+def test_related_objects_are_fetched_with_the_loading_client():
+    api = PetsAPI()
+    pet = Pet.objects.using(api).all()[7]
+
+    assert pet.owner.name == 'Owner 2'
+    assert pet.toys[0].maker.name == 'Owner 11'
+    assert api.get_calls == ['/owners/2', '/owners/11']
+
+    pet = Pet.objects.using(api).get(3)
+    assert pet.owner.name == 'Owner 3'
+    assert api.get_calls[-2:] == ['/pets/3', '/owners/3']
+
+
+def test_related_name_must_not_be_a_field():
+    with pytest.raises(ValueError):
+        class Clash(VismaModel):
+            owner = fields.Nested('OwnerSchema', data_key='Owner')
+            owner_id = fields.Integer(data_key='OwnerId')
+
+            class Meta:
+                related = {'owner': ('owner_id', 'Owner')}
+
+
+class CachedThing(VismaModel):
+    id = fields.Integer(data_key='Id', allow_none=True)
+    name = fields.String(data_key='Name', allow_none=True)
+
+    class Meta:
+        endpoint = '/cachedthings'
+        allowed_methods = ['list', 'get', 'update']
+        envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+        cache = {'ttl': 60, 'max_entries': 2}
+
+
+def test_model_cache():
+    api = FakeAPI([{'Id': i, 'Name': f'Thing {i}'} for i in range(10)])
+    objects = CachedThing.objects.using(api)
+    cache = CachedThing.objects.cache
+
+    first = list(objects.all())
+    first[0].name = 'Edited'
+    second = list(objects.all())
+    assert second[0] is not first[0]
+    assert [thing.name for thing in second] == [
+        f'Thing {i}' for i in range(10)]
+    thing = objects.get(3)
+    thing.name = 'Edited'
+    assert objects.get(3).name == 'Thing 3'
+    assert objects.get(3).changed_fields == set()
+    assert len(api.calls) == 1
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    # Other queries and clients are cached separately.
+    list(objects.filter(name='Thing 1'))
+    list(CachedThing.objects.using(FakeAPI([])).all())
+    assert len(api.calls) == 2
+    assert cache.evictions == 2
+
+    objects.update(first[0])
+    assert len(cache) == 0
+    list(objects.all())
+    assert len(api.calls) == 3
+
+    cache.invalidate()
+    cache.ttl = 0
+    list(objects.all())
+    list(objects.all())
+    assert len(api.calls) == 5
+
+
+def test_model_cache_copies_raw_rows(monkeypatch):
+    api = FakeAPI([{'Id': i, 'Name': f'Thing {i}'} for i in range(10)])
+    objects = CachedThing.objects.using(api)
+    monkeypatch.setattr(CachedThing.objects.cache, 'ttl', 60)
+
+    rows = list(objects.all().raw())
+    rows[0]['Name'] = 'Edited'
+    assert list(objects.all().raw())[0]['Name'] == 'Thing 0'
+    assert len(api.calls) == 1
+
+
+def test_model_cache_async(monkeypatch):
+    api = AsyncFakeAPI([{'Id': i, 'Name': f'Thing {i}'} for i in range(10)])
+    objects = CachedThing.objects.using(api)
+    cache = CachedThing.objects.cache
+    cache.invalidate()
+    monkeypatch.setattr(cache, 'ttl', 60)
+    hits, misses = cache.hits, cache.misses
+
+    async def run():
+        return await objects.aget(3), await objects.aget(3)
+
+    first, second = asyncio.run(run())
+    assert second is not first
+    assert objects.get(3).name == second.name == 'Thing 3'
+    assert (cache.hits - hits, cache.misses - misses) == (2, 1)
+
+
+class ChangedThing(VismaModel):
+    id = fields.Integer(data_key='Id', allow_none=True)
+    changed_utc = fields.DateTime(data_key='ChangedUtc', allow_none=True)
+
+    class Meta:
+        endpoint = '/changedthings'
+        allowed_methods = ['list']
+        envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+
+
+class AwareDateTime(fields.DateTime):
+    """
+    Loads the times in UTC+2 with the time zone set.
+    """
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        value = super()._deserialize(value, attr, data, **kwargs)
+        return value.replace(tzinfo=datetime.timezone.utc).astimezone(
+            datetime.timezone(datetime.timedelta(hours=2)))
+
+
+class AwareChangedThing(VismaModel):
+    id = fields.Integer(data_key='Id', allow_none=True)
+    changed_utc = AwareDateTime(data_key='ChangedUtc', allow_none=True)
+
+    class Meta:
+        endpoint = '/awarechangedthings'
+        allowed_methods = ['list']
+        envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+
+
+class ChangedAPI(FakeAPI):
+
+    def get_rows(self, endpoint, params):
+        rows = self.rows
+        if params.get('$orderby') == 'ChangedUtc':
+            rows = sorted(rows, key=lambda row: row['ChangedUtc'])
+        match = re.fullmatch(r'ChangedUtc (gt|ge) (\S+)Z',
+                             params.get('$filter', ''))
+        if match is None:
+            return rows
+        operator, since = match.group(1), match.group(2)[:19]
+        return [row for row in rows
+                if row['ChangedUtc'][:19] > since or
+                (operator == 'ge' and row['ChangedUtc'][:19] == since)]
+
+
+def test_sync(tmp_path):
+    api = ChangedAPI([{'Id': i, 'ChangedUtc': f'2020-01-0{i + 1}T12:00:00Z'}
+                      for i in range(3)])
+    objects = ChangedThing.objects.using(api)
+    store = WatermarkStore(str(tmp_path / 'watermarks.json'))
+
+    since = datetime.datetime(2020, 1, 2, 13, tzinfo=datetime.timezone(
+        datetime.timedelta(hours=2)))
+    list(objects.changed_since(since))
+    assert api.calls[-1]['$filter'] == 'ChangedUtc gt 2020-01-02T11:00:00Z'
+
+    assert [obj.id for obj in objects.sync(store)] == [0, 1, 2]
+    assert 'ChangedUtc' not in api.calls[-1].get('$filter', '')
+    assert list(objects.sync(store)) == []
+
+    api.rows[1]['ChangedUtc'] = '2020-01-05T12:00:00Z'
+    assert [obj.id for obj in objects.sync(store)] == [1]
+    assert store.get('ChangedThing', 'default') == datetime.datetime(
+        2020, 1, 5, 12)
+
+    store.reset('ChangedThing')
+    assert len(list(objects.sync(store))) == 3
+
+
+def test_sync_changes_at_the_watermark(tmp_path, monkeypatch):
+    api = ChangedAPI([{'Id': i, 'ChangedUtc': '2020-01-01T12:00:00Z'}
+                      for i in range(2)])
+    objects = ChangedThing.objects.using(api)
+    store = WatermarkStore(str(tmp_path / 'watermarks.json'))
+
+    assert [obj.id for obj in objects.sync(store)] == [0, 1]
+    assert api.calls[-1]['$orderby'] == 'ChangedUtc'
+
+    # Saved at the time of the watermark, and a bit before it but after the
+    # last sync.
+    api.rows.append({'Id': 2, 'ChangedUtc': '2020-01-01T12:00:00Z'})
+    api.rows.append({'Id': 3, 'ChangedUtc': '2020-01-01T11:59:58Z'})
+    assert [obj.id for obj in objects.sync(store)] == [3, 2]
+    assert api.calls[-1]['$filter'] == 'ChangedUtc ge 2020-01-01T11:59:55Z'
+    assert list(objects.sync(store)) == []
+
+    # More objects changed at the same time than fit in a batch.
+    monkeypatch.setattr(objects, 'SYNC_BATCH_SIZE', 2)
+    store.reset('ChangedThing')
+    assert [obj.id for obj in objects.sync(store)] == [3, 0, 1, 2]
+    assert list(objects.sync(store)) == []
+
+
+def test_sync_with_aware_times(tmp_path):
+    api = ChangedAPI([{'Id': i, 'ChangedUtc': f'2020-01-0{i + 1}T12:00:00Z'}
+                      for i in range(3)])
+    objects = AwareChangedThing.objects.using(api)
+    store = WatermarkStore(str(tmp_path / 'watermarks.json'))
+
+    since = datetime.datetime(2020, 1, 1, 13)
+    assert [obj.id for obj in objects.sync(store, since=since)] == [1, 2]
+    assert store.get('AwareChangedThing', 'default') == datetime.datetime(
+        2020, 1, 3, 12)
+    assert list(objects.sync(store)) == []
@@ -0,0 +1 @@
+from visma.clients import tenant, register_client, get_client, TenantPool
@@ -1,36 +1,64 @@
 import json
 import datetime
+import logging
+import random
+import threading
+import time
+import os
 import iso8601
 import requests
+from email.utils import parsedate_to_datetime
 from os import environ
 
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
 from marshmallow import fields
 
+from visma.cache import ResponseCache, MemoryResponseCache
 from visma.query import QueryCompiler, FilterParser
+from visma.utils import file_lock
+
+logger = logging.getLogger(__name__)
+
+
+def format_filter_value(value):
+    """
+    Formats dates and times as OData literals. Times without a time zone are
+    taken to be in UTC.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(
+                tzinfo=None)
+        return value.isoformat() + 'Z'
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
 
 
 class GreaterThanFilterParser(FilterParser):
 
     def parse(self):
-        return f'{self.field.data_key} gt {self.value}'
+        return f'{self.field.data_key} gt {format_filter_value(self.value)}'
 
 
 class GreaterOrEqualThanFilterParser(FilterParser):
 
     def parse(self):
-        return f'{self.field.data_key} ge {self.value}'
+        return f'{self.field.data_key} ge {format_filter_value(self.value)}'
 
 
 class LessThanFilterParser(FilterParser):
 
     def parse(self):
-        return f'{self.field.data_key} lt {self.value}'
+        return f'{self.field.data_key} lt {format_filter_value(self.value)}'
 
 
 class LessOrEqualThanFilterParser(FilterParser):
 
     def parse(self):
-        return f'{self.field.data_key} le {self.value}'
+        return f'{self.field.data_key} le {format_filter_value(self.value)}'
 
 
 class EqualFilterParser(FilterParser):
@@ -43,16 +71,36 @@ class EqualFilterParser(FilterParser):
             return f'{self.field.data_key} eq \'{self.value}\''
 
         else:
-            return f'{self.field.data_key} eq {self.value}'
+            return f'{self.field.data_key} eq {format_filter_value(self.value)}'
+
+
+class InFilterParser(FilterParser):
+
+    def parse(self):
+        params = [EqualFilterParser(self.key, value, self.field).parse()
+                  for value in self.value]
+        return '(' + ' or '.join(params) + ')'
+
+
+class NotInFilterParser(FilterParser):
+
+    def parse(self):
+        params = [NotEqualFilterParser(self.key, value, self.field).parse()
+                  for value in self.value]
+        return '(' + ' and '.join(params) + ')'
 
 
 class NotEqualFilterParser(FilterParser):
 
     def parse(self):
-        if isinstance(self.value, str):
+        if isinstance(self.field, fields.UUID):
             return f'{self.field.data_key} ne {self.value}'
+
+        elif isinstance(self.field, fields.String):
+            return f'{self.field.data_key} ne \'{self.value}\''
+
         else:
-            return f'{self.field.data_key} ne {self.value}'
+            return f'{self.field.data_key} ne {format_filter_value(self.value)}'
 
 
 class OrderByFilterParser(FilterParser):
@@ -68,7 +116,10 @@ class VismaQueryCompiler(QueryCompiler):
     greater_or_equal_parser_class = GreaterOrEqualThanFilterParser
     less_than_parser_class = LessThanFilterParser
     less_or_equal_parser_class = LessOrEqualThanFilterParser
+    in_parser_class = InFilterParser
+    not_in_parser_class = NotInFilterParser
     order_by_parser_class = OrderByFilterParser
+    order_param = '$orderby'
 
 
 class VismaAPIException(Exception):
@@ -81,6 +132,200 @@ class VismaClientException(Exception):
     pass
 
 
+class RetryPolicy:
+    """
+    Decides if a failed request should be retried and how long to wait before
+    retrying.
+
+    Requests are retried on connection errors, timeouts and the status codes
+    in ``status_codes``. Only idempotent methods are retried unless
+    ``retry_post`` is set, since retrying a POST might create duplicates.
+    The wait is taken from the Retry-After header if the response has one,
+    otherwise it is an exponential backoff with full jitter. A request is not
+    retried if Retry-After asks us to wait longer than ``max_retry_after``.
+
+    :param int max_retries: Max number of retries of a single request.
+    :param float backoff_factor: Seconds to base the backoff on. The wait
+        before retry n is a random time up to backoff_factor * 2 ** n.
+    :param float max_backoff: Max seconds to wait between retries when the
+        response has no Retry-After header.
+    :param bool retry_post: Also retry POST requests.
+    :param int retry_budget: Max number of retries per retry_budget_window
+        seconds for all requests using the policy. The budget is refilled
+        continuously. None means no limit.
+    :param float retry_budget_window: Seconds it takes to refill the whole
+        retry budget.
+    :param float max_retry_after: Max seconds to wait for a Retry-After
+        header.
+    :param status_codes: HTTP status codes to retry on.
+    """
+
+    STATUS_CODES = (429, 500, 502, 503, 504)
+    IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30,
+                 retry_post=False, retry_budget=None, retry_budget_window=60,
+                 max_retry_after=120, status_codes=None):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_post = retry_post
+        self.retry_budget = retry_budget
+        self.retry_budget_window = retry_budget_window
+        self.max_retry_after = max_retry_after
+        self.status_codes = status_codes or self.STATUS_CODES
+        self.retries = 0
+        # Retries left of the budget and when it was last refilled.
+        self._budget = retry_budget
+        self._budget_updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def should_retry(self, method, attempt, response=None):
+        """
+        Returns True if a request should be retried. Pass the response if
+        one was received. Retrying uses up one retry of the budget.
+        """
+        if attempt >= self.max_retries:
+            return False
+
+        if method not in self.IDEMPOTENT_METHODS and not (
+                method == 'POST' and self.retry_post):
+            return False
+
+        if response is not None and (
+                response.status_code not in self.status_codes):
+            return False
+
+        retry_after = self.get_retry_after(response)
+        if retry_after is not None and retry_after > self.max_retry_after:
+            logger.warning(f'Not retrying, Retry-After is {retry_after}s')
+            return False
+
+        with self._lock:
+            if self.retry_budget is not None:
+                now = time.monotonic()
+                self._budget = min(
+                    self.retry_budget,
+                    self._budget + (now - self._budget_updated) *
+                    self.retry_budget / self.retry_budget_window)
+                self._budget_updated = now
+                if self._budget < 1:
+                    logger.warning('Retry budget exhausted')
+                    return False
+                self._budget -= 1
+            self.retries += 1
+        return True
+
+    def get_backoff(self, attempt, response=None):
+        """
+        Seconds to wait before making retry number attempt + 1.
+        """
+        retry_after = self.get_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+
+        backoff = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+        return random.uniform(0, backoff)
+
+    @staticmethod
+    def get_retry_after(response):
+        if response is None:
+            return None
+
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        return max((retry_at - now).total_seconds(), 0)
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter. Allows ``rate`` requests per second on average
+    with bursts of up to ``burst`` requests.
+
+    Each call takes a token from the bucket. If the bucket is empty the
+    token is reserved from the future and the caller waits until it is
+    available, so callers are served in the order they arrived. Taking a
+    token is thread safe and never blocks the event loop, so the same limiter
+    can be used from threads with :meth:`acquire` and from coroutines with
+    :meth:`acquire_async`.
+
+    ``requests``, ``waits`` and ``wait_time`` count the number of acquired
+    tokens, how many of them had to wait and the total seconds waited.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        import asyncio
+
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def _reserve(self):
+        """
+        Takes a token and returns the seconds to wait before using it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            self.requests += 1
+
+            if self.tokens >= 0:
+                return 0
+
+            wait = -self.tokens / self.rate
+            self.waits += 1
+            self.wait_time += wait
+            return wait
+
+
+_rate_limiters = dict()
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(tenant, rate, burst=None):
+    """
+    Returns the rate limiter of a tenant, creating it if it doesn't exist.
+    All API objects for the same tenant share the limiter so they are
+    throttled together.
+    """
+    with _rate_limiters_lock:
+        rate_limiter = _rate_limiters.get(tenant)
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(rate, burst)
+            _rate_limiters[tenant] = rate_limiter
+        return rate_limiter
+
+
 class VismaAPI:
     """
     Class containing methods to interact with the Visma E-Accounting API
@@ -94,9 +339,45 @@ class VismaAPI:
 
     QUERY_COMPILER_CLASS = VismaQueryCompiler
 
+    # Number of host connection pools to keep and the maximum number of
+    # keep-alive connections in each pool.
+    POOL_CONNECTIONS = 10
+    POOL_MAXSIZE = 10
+    # Seconds a pooled session may be unused before it is closed and replaced.
+    POOL_IDLE_TIMEOUT = 60
+
+    # Number of pages of a list result that may be fetched at the same time.
+    MAX_CONCURRENT_PAGES = 1
+
+    # Limits for the adaptive page size. Pages are made smaller when a
+    # response takes longer than MAX_PAGE_LATENCY seconds or is larger than
+    # MAX_PAGE_PAYLOAD bytes.
+    MAX_PAGE_LATENCY = 2.0
+    MAX_PAGE_PAYLOAD = 2 * 1024 * 1024
+
+    # Seconds to wait for the server to respond before the request times
+    # out.
+    TIMEOUT = 60
+
+    TIMEOUT_EXCEPTIONS = (requests.Timeout,)
+    RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+
+    # Max number of requests per second per tenant. None means no limit.
+    RATE_LIMIT = None
+
+    # Seconds before the token expires that we start refreshing it.
+    TOKEN_REFRESH_MARGIN = 30
+
     def __init__(self, client_id, client_secret,
                  access_token, refresh_token, token_expires, token_path=None,
-                 test=False):
+                 test=False, pool_connections=None, pool_maxsize=None,
+                 pool_idle_timeout=None, max_concurrent_pages=None,
+                 page_size=None, adaptive_page_size=False,
+                 max_page_latency=None, max_page_payload=None,
+                 retry_policy=None, tenant=None, rate_limit=None,
+                 rate_limit_burst=None, rate_limiter=None,
+                 response_cache=None, conditional_requests=False,
+                 timeout=None):
 
         self.client_id = client_id
         self.client_secret = client_secret
@@ -106,45 +387,222 @@ class VismaAPI:
         self.token_path = token_path
         self.test = test
 
+        self.pool_connections = pool_connections or self.POOL_CONNECTIONS
+        self.pool_maxsize = pool_maxsize or self.POOL_MAXSIZE
+        if pool_idle_timeout is None:
+            pool_idle_timeout = self.POOL_IDLE_TIMEOUT
+        self.pool_idle_timeout = pool_idle_timeout
+
+        self.max_concurrent_pages = (max_concurrent_pages or
+                                     self.MAX_CONCURRENT_PAGES)
+
+        self.timeout = timeout or self.TIMEOUT
+
+        self.page_size = page_size
+        self.adaptive_page_size = adaptive_page_size
+        self.max_page_latency = max_page_latency or self.MAX_PAGE_LATENCY
+        self.max_page_payload = max_page_payload or self.MAX_PAGE_PAYLOAD
+        # Adaptive page sizes per endpoint.
+        self.page_sizers = dict()
+
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        # Identifies the company the tokens give access to. Defaults to the
+        # token file since there is one per company.
+        self.tenant = tenant or token_path or client_id
+
+        rate_limit = rate_limit or self.RATE_LIMIT
+        if rate_limiter is None and rate_limit:
+            rate_limiter = get_rate_limiter(self.tenant, rate_limit,
+                                            rate_limit_burst)
+        self.rate_limiter = rate_limiter
+
+        # Optional ResponseCache for GET responses. Expired responses are
+        # revalidated with conditional requests. With conditional_requests
+        # the responses are kept in memory to be revalidated on every GET.
+        if response_cache is None and conditional_requests:
+            response_cache = MemoryResponseCache()
+        self.response_cache = response_cache
+
+        self._session = None
+        self._session_last_used = None
+        self._session_lock = threading.Lock()
+        self._token_lock = threading.Lock()
+
         if self.token_expired:
             self._refresh_token()
 
     # TODO: Can I make a decorator to handle errors from the API?
 
     def get(self, endpoint, params=None, **kwargs):
-        url = self._format_url(endpoint)
-        headers = self.api_headers
-
-        r = requests.get(url, params, headers=headers, **kwargs)
+        cached = self._get_cached(endpoint, params)
+        if cached is not None:
+            if cached.fresh:
+                return self._make_cached_response(endpoint, cached)
+            kwargs['headers'] = dict(kwargs.get('headers') or dict(),
+                                     **cached.validators)
+
+        r = self._request('GET', endpoint, params=params, **kwargs)
+        if r.status_code == 304 and cached is not None:
+            self.response_cache.refresh(self.tenant, endpoint, params)
+            return self._make_cached_response(endpoint, cached)
         if not r.ok:
             raise VismaAPIException(
                 f'GET {r.request.url} :: HTTP:{r.status_code}, {r.content}')
+        self._set_cached(endpoint, params, r)
         return r
 
     def post(self, endpoint, data, *args, **kwargs):
-        url = self._format_url(endpoint)
-        r = requests.post(url, data, *args, headers=self.api_headers, **kwargs)
+        if args:
+            kwargs['json'] = args[0]
+        r = self._request('POST', endpoint, data=data, **kwargs)
         if not r.ok:
             raise VismaAPIException(
                 f'POST :: HTTP:{r.status_code}, {r.content}')
+        self._invalidate_cached(endpoint)
         return r
 
     def put(self, endpoint, data, **kwargs):
-        url = self._format_url(endpoint)
-        r = requests.put(url, data, headers=self.api_headers, **kwargs)
+        r = self._request('PUT', endpoint, data=data, **kwargs)
         if not r.ok:
             raise VismaAPIException(
                 f'PUT :: HTTP:{r.status_code}, {r.content}')
+        self._invalidate_cached(endpoint)
         return r
 
     def delete(self, endpoint, **kwargs):
-        url = self._format_url(endpoint)
-        r = requests.delete(url, headers=self.api_headers, **kwargs)
+        r = self._request('DELETE', endpoint, **kwargs)
         if not r.ok:
             raise VismaAPIException(
                 f'DELETE :: HTTP:{r.status_code}, {r.content}')
+        self._invalidate_cached(endpoint)
         return r
 
+    def _get_cached(self, endpoint, params):
+        if self.response_cache is None:
+            return None
+        # Expired responses are returned too, to be revalidated.
+        return self.response_cache.get(self.tenant, endpoint, params,
+                                       stale=True)
+
+    def _set_cached(self, endpoint, params, response):
+        if self.response_cache is not None:
+            self.response_cache.set(self.tenant, endpoint, params,
+                                    response.status_code, response.headers,
+                                    response.content)
+
+    def _invalidate_cached(self, endpoint):
+        if self.response_cache is not None:
+            self.response_cache.invalidate(self.tenant, endpoint)
+
+    def _make_cached_response(self, endpoint, cached):
+        """
+        Makes a :class:`requests.Response` from a cached response.
+        """
+        response = requests.Response()
+        response.status_code = cached.status_code
+        response.headers = CaseInsensitiveDict(cached.headers)
+        response._content = cached.content
+        response.encoding = 'utf-8'
+        response.url = self._format_url(endpoint)
+        response.cached = cached
+        return response
+
+    def _request(self, method, endpoint, retry_timeouts=True, **kwargs):
+        """
+        Makes a request to the API and retries it according to the retry
+        policy. Returns the last response, even if it wasn't successful.
+        Timeouts are raised instead of retried if retry_timeouts is False.
+        """
+        url = self._format_url(endpoint)
+        attempt = 0
+        replayed = False
+        headers = kwargs.pop('headers', None) or dict()
+        kwargs.setdefault('timeout', self.timeout)
+
+        while True:
+            self._ensure_token()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            response = None
+            access_token = self.access_token
+            try:
+                response = self.session.request(
+                    method, url, headers=dict(self.api_headers, **headers),
+                    **kwargs)
+            except self.RETRY_EXCEPTIONS as e:
+                if not retry_timeouts and isinstance(
+                        e, self.TIMEOUT_EXCEPTIONS):
+                    raise
+                if not self.retry_policy.should_retry(method, attempt):
+                    raise
+                logger.info(f'{method} {url} failed with {e!r}')
+            else:
+                if response.status_code == 401 and not replayed:
+                    # The token might have expired or been refreshed by
+                    # someone else. Refresh it and replay the request once.
+                    logger.info(f'{method} {url} was unauthorized. '
+                                f'Refreshing token')
+                    self._ensure_token(rejected_token=access_token)
+                    replayed = True
+                    continue
+                if response.ok or not self.retry_policy.should_retry(
+                        method, attempt, response):
+                    return response
+                logger.info(f'{method} {url} failed with '
+                            f'HTTP:{response.status_code}')
+
+            backoff = self.retry_policy.get_backoff(attempt, response)
+            logger.info(f'Retrying {method} {url} in {backoff:.2f}s')
+            time.sleep(backoff)
+            attempt += 1
+
+    @property
+    def session(self):
+        """
+        The pooled :class:`requests.Session` used for all calls to the API.
+        Connections are kept alive between calls and shared by all managers
+        using this API object. A session that has been idle for longer than
+        ``pool_idle_timeout`` seconds is closed and replaced, so we don't try
+        to reuse connections the server has already dropped.
+        """
+        with self._session_lock:
+            now = time.monotonic()
+            if (self._session is not None and self.pool_idle_timeout and
+                    now - self._session_last_used > self.pool_idle_timeout):
+                self._session.close()
+                self._session = None
+
+            if self._session is None:
+                self._session = self._create_session()
+
+            self._session_last_used = now
+            return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def _format_url(self, endpoint):
         if self.test:
             url = self.API_URL_TEST + endpoint
@@ -168,7 +626,55 @@ class VismaAPI:
         else:
             return False
 
-    def _refresh_token(self):
+    @property
+    def token_expires_soon(self):
+        margin = datetime.timedelta(seconds=self.TOKEN_REFRESH_MARGIN)
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        return now + margin > self.token_expires
+
+    def _ensure_token(self, rejected_token=None):
+        """
+        Refreshes the token if it is about to expire or if rejected_token,
+        the token a request was made with, was rejected by the API.
+
+        Only one thread refreshes the token at a time. Threads waiting for the
+        refresh use the new token instead of refreshing again.
+        """
+        if rejected_token is None and not self.token_expires_soon:
+            return
+
+        with self._token_lock:
+            if rejected_token is not None:
+                if self.access_token != rejected_token:
+                    return
+            elif not self.token_expires_soon:
+                return
+
+            self._refresh_token(rejected_token=rejected_token)
+
+    def _refresh_token(self, rejected_token=None):
+        """
+        Refreshes the token and saves it to the token file.
+
+        The token file is locked during the refresh so processes sharing it
+        don't refresh at the same time and invalidate each others refresh
+        tokens. If another process has already refreshed the token we use the
+        token from the file instead.
+        """
+        with file_lock(self.token_path):
+            if self.token_path is not None and os.path.exists(
+                    self.token_path):
+                self._read_tokens()
+                if (self.access_token != rejected_token and
+                        not self.token_expires_soon):
+                    return
+
+            self._request_token()
+
+            if self.token_path is not None:
+                self._write_tokens()
+
+    def _request_token(self):
 
         if self.test:
             url = self.TOKEN_URL_TEST
@@ -180,9 +686,9 @@ class VismaAPI:
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded;charset=UTF-8'
         }
-        response = requests.post(url, data,
-                                 auth=(self.client_id, self.client_secret),
-                                 headers=headers)
+        response = self.session.post(url, data,
+                                     auth=(self.client_id, self.client_secret),
+                                     headers=headers, timeout=self.timeout)
 
         if response.status_code != 200:
             raise VismaAPIException(f'Couldn\'t refresh token: '
@@ -201,36 +707,49 @@ class VismaAPI:
             expires = now + expiry_time
             self.token_expires = expires
 
-        self._save_tokens()
-
     def _load_tokens(self):
         """
         Load tokens from json file
         """
+        with file_lock(self.token_path):
+            self._read_tokens()
+
+    def _save_tokens(self):
+        """
+        Save tokens to json file
+        """
+        with file_lock(self.token_path):
+            self._write_tokens()
+
+    def _read_tokens(self):
         with open(self.token_path) as cred_file:
             tokens = json.load(cred_file)
             self.access_token = tokens['access_token']
             self.refresh_token = tokens['refresh_token']
             self.token_expires = iso8601.parse_date(tokens['expires'])
 
-    def _save_tokens(self):
-        """
-        Save tokens to json file
-        """
+    def _write_tokens(self):
         tokens = {'access_token': self.access_token,
                   'refresh_token': self.refresh_token,
                   'expires': self.token_expires.isoformat()}
 
-        with open(self.token_path, 'w') as token_file:
+        # Write to a temporary file and replace so that readers not taking
+        # the lock never see a half written file.
+        tmp_path = f'{self.token_path}.tmp'
+        with open(tmp_path, 'w') as token_file:
             json.dump(tokens, token_file)
+        os.replace(tmp_path, self.token_path)
 
     @classmethod
-    def load(cls):
+    def load(cls, token_path=None):
         """
-        Load tokens from json file
+        Load tokens from json file. The file is given by token_path or the
+        VISMA_API_TOKEN_PATH environment variable.
         """
 
         env = cls.get_api_settings_from_env()
+        if token_path is not None:
+            env['token_path'] = token_path
 
         access_token = None
         refresh_token = None
@@ -244,18 +763,36 @@ class VismaAPI:
                 refresh_token = tokens['refresh_token']
                 token_expires = iso8601.parse_date(tokens['expires'])
 
+        response_cache = None
+        if env['cache_path'] is not None:
+            response_cache = ResponseCache(env['cache_path'],
+                                           ttl=env['cache_ttl'])
+
         return cls(env['client_id'], env['client_secret'],
                    access_token=access_token,
                    refresh_token=refresh_token,
                    token_expires=token_expires,
                    token_path=env['token_path'],
-                   test=env['test'])
+                   test=env['test'],
+                   rate_limit=env['rate_limit'],
+                   response_cache=response_cache)
 
     @staticmethod
     def get_api_settings_from_env():
         settings = {'token_path': environ.get('VISMA_API_TOKEN_PATH'),
                     'client_id': environ.get('VISMA_API_CLIENT_ID'),
-                    'client_secret': environ.get('VISMA_API_CLIENT_SECRET')}
+                    'client_secret': environ.get('VISMA_API_CLIENT_SECRET'),
+                    'rate_limit': None,
+                    'cache_path': environ.get('VISMA_API_CACHE_PATH'),
+                    'cache_ttl': 300}
+
+        rate_limit = environ.get('VISMA_API_RATE_LIMIT')
+        if rate_limit:
+            settings['rate_limit'] = float(rate_limit)
+
+        cache_ttl = environ.get('VISMA_API_CACHE_TTL')
+        if cache_ttl:
+            settings['cache_ttl'] = float(cache_ttl)
 
         if environ.get('VISMA_API_ENV') == 'test':
             settings['test'] = True
@@ -265,6 +802,178 @@ class VismaAPI:
 
         return settings
 
+
+def _import_httpx():
+    # httpx is only imported when the async client is used, since importing
+    # it takes longer than the rest of the package.
+    try:
+        import httpx
+    except ImportError:
+        raise VismaClientException(
+            'AsyncVismaAPI requires httpx. '
+            'Install it with pip install visma[async]') from None
+    return httpx
+
+
+class AsyncVismaAPI(VismaAPI):
+    """
+    Asyncio version of :class:`VismaAPI`. The get, post, put and delete
+    methods are coroutines, so it is used with the async methods of managers
+    and querysets, ex ``await Customer.objects.aget(pk)``.
+
+    Requires httpx, install with ``pip install visma[async]``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        httpx = _import_httpx()
+        self.TIMEOUT_EXCEPTIONS = (httpx.TimeoutException,)
+        self.RETRY_EXCEPTIONS = (httpx.TransportError,)
+        self._client = None
+        super().__init__(*args, **kwargs)
+
+    async def get(self, endpoint, params=None, **kwargs):
+        cached = self._get_cached(endpoint, params)
+        if cached is not None:
+            if cached.fresh:
+                return self._make_cached_response(endpoint, cached)
+            kwargs['headers'] = dict(kwargs.get('headers') or dict(),
+                                     **cached.validators)
+
+        r = await self._request('GET', endpoint, params=params, **kwargs)
+        if r.status_code == 304 and cached is not None:
+            self.response_cache.refresh(self.tenant, endpoint, params)
+            return self._make_cached_response(endpoint, cached)
+        if not r.is_success:
+            raise VismaAPIException(
+                f'GET {r.request.url} :: HTTP:{r.status_code}, {r.content}')
+        self._set_cached(endpoint, params, r)
+        return r
+
+    async def post(self, endpoint, data, *args, **kwargs):
+        if args:
+            kwargs['json'] = args[0]
+        r = await self._request('POST', endpoint, content=data, **kwargs)
+        if not r.is_success:
+            raise VismaAPIException(
+                f'POST :: HTTP:{r.status_code}, {r.content}')
+        self._invalidate_cached(endpoint)
+        return r
+
+    async def put(self, endpoint, data, **kwargs):
+        r = await self._request('PUT', endpoint, content=data, **kwargs)
+        if not r.is_success:
+            raise VismaAPIException(
+                f'PUT :: HTTP:{r.status_code}, {r.content}')
+        self._invalidate_cached(endpoint)
+        return r
+
+    async def delete(self, endpoint, **kwargs):
+        r = await self._request('DELETE', endpoint, **kwargs)
+        if not r.is_success:
+            raise VismaAPIException(
+                f'DELETE :: HTTP:{r.status_code}, {r.content}')
+        self._invalidate_cached(endpoint)
+        return r
+
+    def _make_cached_response(self, endpoint, cached):
+        """
+        Makes a :class:`httpx.Response` from a cached response.
+        """
+        httpx = _import_httpx()
+        request = httpx.Request('GET', self._format_url(endpoint))
+        response = httpx.Response(cached.status_code, headers=cached.headers,
+                                  content=cached.content, request=request)
+        response.cached = cached
+        return response
+
+    async def _request(self, method, endpoint, retry_timeouts=True,
+                       **kwargs):
+        import asyncio
+
+        url = self._format_url(endpoint)
+        attempt = 0
+        replayed = False
+        headers = kwargs.pop('headers', None) or dict()
+        kwargs.setdefault('timeout', self.timeout)
+
+        while True:
+            await self._aensure_token()
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async()
+
+            response = None
+            access_token = self.access_token
+            try:
+                response = await self.client.request(
+                    method, url, headers=dict(self.api_headers, **headers),
+                    **kwargs)
+            except self.RETRY_EXCEPTIONS as e:
+                if not retry_timeouts and isinstance(
+                        e, self.TIMEOUT_EXCEPTIONS):
+                    raise
+                if not self.retry_policy.should_retry(method, attempt):
+                    raise
+                logger.info(f'{method} {url} failed with {e!r}')
+            else:
+                if response.status_code == 401 and not replayed:
+                    logger.info(f'{method} {url} was unauthorized. '
+                                f'Refreshing token')
+                    await self._aensure_token(rejected_token=access_token)
+                    replayed = True
+                    continue
+                if response.is_success or not self.retry_policy.should_retry(
+                        method, attempt, response):
+                    return response
+                logger.info(f'{method} {url} failed with '
+                            f'HTTP:{response.status_code}')
+
+            backoff = self.retry_policy.get_backoff(attempt, response)
+            logger.info(f'Retrying {method} {url} in {backoff:.2f}s')
+            await asyncio.sleep(backoff)
+            attempt += 1
+
+    async def _aensure_token(self, rejected_token=None):
+        """
+        Refreshes the token in a worker thread, so the event loop isn't
+        blocked by the refresh or by waiting for the token locks.
+        """
+        if rejected_token is None and not self.token_expires_soon:
+            return
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._ensure_token, rejected_token)
+
+    @property
+    def client(self):
+        """
+        The pooled :class:`httpx.AsyncClient` used for all calls to the API.
+        """
+        if self._client is None:
+            httpx = _import_httpx()
+            limits = httpx.Limits(
+                max_connections=self.pool_maxsize * self.pool_connections,
+                max_keepalive_connections=self.pool_maxsize,
+                keepalive_expiry=self.pool_idle_timeout)
+            self._client = httpx.AsyncClient(limits=limits)
+        return self._client
+
+    async def aclose(self):
+        """
+        Close all pooled connections.
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+
 class NoAPI:
 
     @classmethod
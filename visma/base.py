@@ -1,20 +1,294 @@
-import copy
-import os
+import logging
+import uuid
 
-from marshmallow import Schema, post_load, fields
+from marshmallow import Schema, post_load, fields, class_registry
 from marshmallow.base import FieldABC
 from marshmallow.utils import _Missing
 
+from visma.cache import ModelCache
 from visma.manager import Manager
-from visma.utils import is_instance_or_subclass, import_string
+from visma.utils import is_instance_or_subclass
+
+logger = logging.getLogger(__name__)
 
 
 class VismaSchema(Schema):
     visma_model = None
+    # Use the compiled loader and dumper instead of marshmallow. Set with
+    # fast_path in the model Meta.
+    use_fast_path = True
 
     @post_load
     def make_instance(self, data):
-        return self.visma_model(**data)
+        obj = self.visma_model(**data)
+        obj._changed_fields.clear()
+        return obj
+
+    def load_model(self, data):
+        """
+        Load data into a model object. Uses the compiled loader unless the
+        model has turned it off, in which case marshmallow loads and
+        validates the data.
+        """
+        if self.use_fast_path:
+            return self.fast_load(data)
+        return self.load(data)
+
+    def dump_model(self, obj, only=None):
+        """
+        Dump a model object. Uses the compiled dumper unless the model has
+        turned it off. If only is given just those fields are dumped.
+        """
+        if self.use_fast_path:
+            return self.fast_dump(obj, only=only)
+        data = self.dump(obj)
+        if only is not None:
+            data_keys = {self.fields[field_name].data_key or field_name
+                         for field_name in only}
+            data = {key: value for key, value in data.items()
+                    if key in data_keys}
+        return data
+
+    def fast_load(self, data):
+        """
+        Load data with a loader compiled for the schema. Values are converted
+        to the field types but not validated.
+        """
+        loader = self.__class__.__dict__.get('_fast_loader')
+        if loader is None:
+            loader = _compile_loader(self)
+            self.__class__._fast_loader = loader
+        return loader(data)
+
+    def fast_dump(self, obj, only=None):
+        """
+        Dump an object with a dumper compiled for the schema.
+        """
+        dumper = self.__class__.__dict__.get('_fast_dumper')
+        if dumper is None:
+            dumper = _compile_dumper(self)
+            self.__class__._fast_dumper = dumper
+        return dumper(obj, only=only)
+
+
+def _get_load_converter(field):
+    """
+    Returns a function converting a JSON value (not None) for field to its
+    Python value.
+    """
+    if isinstance(field, fields.Nested):
+        def convert_nested(value):
+            schema = field.schema
+            if not getattr(schema, 'use_fast_path', False):
+                return field.deserialize(value)
+            if field.many:
+                return [schema.fast_load(item) for item in value]
+            return schema.fast_load(value)
+        return convert_nested
+
+    if isinstance(field, fields.List):
+        convert_item = _get_load_converter(field.container)
+        if convert_item is None:
+            return list
+        return lambda value: [None if item is None else convert_item(item)
+                              for item in value]
+
+    # UUID is a subclass of String so it has to be checked first.
+    if isinstance(field, fields.UUID):
+        return uuid.UUID
+
+    if isinstance(field, (fields.String, fields.Boolean)):
+        return None
+
+    if isinstance(field, fields.Number):
+        return field.num_type
+
+    if isinstance(field, (fields.DateTime, fields.Date)):
+        return lambda value: field._deserialize(value, None, None)
+
+    return field.deserialize
+
+
+def _get_dump_converter(field):
+    """
+    Returns a function converting a Python value (not None) for field to its
+    JSON value.
+    """
+    if isinstance(field, fields.Nested):
+        def convert_nested(value):
+            schema = field.schema
+            if not getattr(schema, 'use_fast_path', False):
+                return schema.dump(value, many=field.many)
+            if field.many:
+                return [schema.fast_dump(item) for item in value]
+            return schema.fast_dump(value)
+        return convert_nested
+
+    if isinstance(field, fields.List):
+        convert_item = _get_dump_converter(field.container)
+        return lambda value: [None if item is None else convert_item(item)
+                              for item in value]
+
+    if isinstance(field, (fields.String, fields.UUID)):
+        return str
+
+    if isinstance(field, fields.Number) and not field.as_string:
+        return field.num_type
+
+    return lambda value: field._serialize(value, None, None)
+
+
+def _compile_loader(schema):
+    model = schema.visma_model
+    converters = tuple(
+        (field_name, field.data_key or field_name, _get_load_converter(field),
+         field_name in model._lazy_fields)
+        for field_name, field in schema.fields.items()
+        if not field.dump_only)
+
+    def load(data):
+        kwargs = {}
+        for field_name, data_key, convert, lazy in converters:
+            try:
+                value = data[data_key]
+            except KeyError:
+                continue
+            if value is not None and convert is not None:
+                if lazy:
+                    value = LazyValue(value, convert)
+                else:
+                    value = convert(value)
+            kwargs[field_name] = value
+        obj = model(**kwargs)
+        obj._changed_fields.clear()
+        return obj
+
+    return load
+
+
+def _compile_dumper(schema):
+    converters = tuple(
+        (field_name, field.data_key or field_name, _get_dump_converter(field))
+        for field_name, field in schema.fields.items()
+        if not field.load_only)
+
+    def dump(obj, only=None):
+        if isinstance(obj, dict):
+            return schema.dump(obj)
+
+        data = {}
+        for field_name, data_key, convert in converters:
+            if only is not None and field_name not in only:
+                continue
+            value = getattr(obj, field_name)
+            if value is not None:
+                value = convert(value)
+            data[data_key] = value
+        return data
+
+    return dump
+
+
+class LazyValue:
+    """
+    Raw JSON of a nested field that is converted when it is first accessed.
+    The raw JSON is kept so that changes to the loaded value can be detected.
+    """
+    __slots__ = ('data', 'convert', 'value', 'loaded')
+
+    def __init__(self, data, convert):
+        self.data = data
+        self.convert = convert
+        self.value = None
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.value = self.convert(self.data)
+            self.loaded = True
+        return self.value
+
+
+class LazyNestedAttribute:
+    """
+    Descriptor for nested fields. The value is kept in the _nested_values
+    dict of the instance and a :class:`LazyValue` is converted to the nested
+    objects on first access.
+    """
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance._nested_values.get(self.field_name)
+        if isinstance(value, LazyValue):
+            if not value.loaded:
+                value.load()
+                # The nested objects fetch their related objects with the
+                # client of the parent.
+                client = getattr(instance, '_client', None)
+                if client is not None:
+                    _set_client(value.value, client)
+            return value.value
+        return value
+
+    def __set__(self, instance, value):
+        instance._nested_values[self.field_name] = value
+
+
+def _set_client(value, client):
+    if isinstance(value, list):
+        for obj in value:
+            if isinstance(obj, VismaModel):
+                obj._set_client(client)
+    elif isinstance(value, VismaModel):
+        value._set_client(client)
+
+
+class RelatedAttribute:
+    """
+    Descriptor for an object referenced by id, declared with related in the
+    model Meta. The object is fetched with a get on its manager, using the
+    client the instance was loaded with, the first time it is accessed,
+    unless it has been attached by prefetch_related.
+    """
+
+    def __init__(self, name, field_name, model_name):
+        self.name = name
+        self.field_name = field_name
+        self.model_name = model_name
+
+    @property
+    def model(self):
+        return class_registry.get_class(f'{self.model_name}Schema').visma_model
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return instance._related_objects[self.name]
+        except KeyError:
+            pass
+        pk = getattr(instance, self.field_name)
+        manager = self.model.objects
+        client = getattr(instance, '_client', None)
+        if client is not None:
+            manager = manager.using(client)
+        obj = None if pk is None else manager.get(pk)
+        instance._related_objects[self.name] = obj
+        return obj
+
+    def __set__(self, instance, obj):
+        setattr(instance, self.field_name, None if obj is None else obj.id)
+        instance._related_objects[self.name] = obj
+
+
+def _is_nested(field):
+    return (isinstance(field, fields.Nested) or (
+        isinstance(field, fields.List) and
+        isinstance(field.container, fields.Nested)))
 
 
 def _get_fields(attrs, field_class):
@@ -27,6 +301,22 @@ def _get_fields(attrs, field_class):
     return fields
 
 
+def _get_field_defaults(schema_attrs):
+    """
+    Returns (field_name, default, allow_none) for every field so that
+    instances can be initialized without looking into the field objects.
+    """
+    field_defaults = []
+    for field_name, field_value in schema_attrs:
+        default = field_value.default
+        if is_instance_or_subclass(default, _Missing):
+            default = None
+        allow_none = field_value.allow_none or field_value.load_only
+        field_defaults.append((field_name, default, allow_none))
+
+    return tuple(field_defaults)
+
+
 class VismaModelMeta(type):
     """Base metaclass for all VismaModels"""
 
@@ -46,10 +336,55 @@ class VismaModelMeta(type):
         new_attrs = attrs
         # TODO: add meta data
 
+        # Nested fields are loaded lazily from the raw JSON when they are
+        # first accessed, unless turned off with lazy_nested in Meta.
+        lazy_fields = frozenset()
+        if getattr(attrs.get('Meta'), 'lazy_nested', True):
+            lazy_fields = frozenset(field_name
+                                    for field_name, field in schema_attrs
+                                    if _is_nested(field))
+
+        # Objects referenced by id, {name: (field_name, model_name)}
+        related = getattr(attrs.get('Meta'), 'related', dict())
+        for related_name in related:
+            if related_name in dict(schema_attrs):
+                raise ValueError(
+                    f'{name} has both a field and a related object named '
+                    f'{related_name}')
+
+        if getattr(attrs.get('Meta'), 'slots', False):
+            # Store the values in slots instead of an instance __dict__. The
+            # field objects can't stay as class attributes since they would
+            # conflict with the slots, they are kept in _schema_items.
+            for field_name, _ in schema_attrs:
+                del new_attrs[field_name]
+            slots = tuple(field_name for field_name, _ in schema_attrs
+                          if field_name not in lazy_fields)
+            slots += ('_changed_fields',)
+            if lazy_fields:
+                slots += ('_nested_values',)
+            if related:
+                slots += ('_related_objects',)
+            slots += ('_client',)
+            new_attrs['__slots__'] = slots
+
+        for field_name in lazy_fields:
+            new_attrs[field_name] = LazyNestedAttribute(field_name)
+
+        for related_name, (field_name, model_name) in related.items():
+            new_attrs[related_name] = RelatedAttribute(related_name,
+                                                       field_name, model_name)
+
         new_class = super().__new__(mcs, name, bases, new_attrs)
+        new_class._lazy_fields = lazy_fields
+        new_class._related = related
+        new_class._related_fields = {
+            field_name: related_name
+            for related_name, (field_name, _) in related.items()}
         schema_name = name + 'Schema'
         schema_dict = dict(schema_attrs)
         new_class._schema_items = dict(schema_attrs)
+        new_class._field_defaults = _get_field_defaults(schema_attrs)
         schema_dict['visma_model'] = new_class
 
         schema_klass = type(schema_name, (VismaSchema,), schema_dict)
@@ -58,6 +393,8 @@ class VismaModelMeta(type):
         attr_meta = attrs.pop('Meta', None)
         meta = attr_meta or getattr(new_class, 'Meta', None)
 
+        schema_klass.use_fast_path = getattr(meta, 'fast_path', True)
+
         endpoint = getattr(meta, 'endpoint', None)
         if endpoint is not None:
             manager = Manager()
@@ -71,11 +408,12 @@ class VismaModelMeta(type):
             # model
             manager.allowed_methods = [method.upper() for method in
                                        allowed_methods]
+            # The API is loaded on first use of the manager, see Manager.api
 
-            api_klass_path = os.environ.get('VISMA_API_CLASS',
-                                            default='visma.api.NoAPI')
-            api_klass = import_string(api_klass_path)
-            manager.api = api_klass.load()
+            cache = getattr(meta, 'cache', None)
+            if cache is not None:
+                manager.cache = ModelCache(**cache)
+            manager.changed_field = getattr(meta, 'changed_field', None)
 
             new_class.objects = manager
 
@@ -104,10 +442,32 @@ class VismaModelMeta(type):
 
 
 class VismaModel(metaclass=VismaModelMeta):
+    # Empty slots so that models with slots = True in Meta don't get an
+    # instance __dict__ from this class.
+    __slots__ = ()
+
     id = None
+    _schema_items = dict()
+    _field_defaults = tuple()
+    _lazy_fields = frozenset()
+    _related = dict()
+    _related_fields = dict()
+    # The client the object was loaded with.
+    _client = None
 
     def __init__(self, *args, **kwargs):
-        self.schema_fields = copy.deepcopy(self._schema_items)
+        # Fields given when creating the object count as changed. Objects
+        # loaded from the API are marked as unchanged by the schema.
+        self._changed_fields = set()
+
+        # The field objects are shared by all instances of the class. Only
+        # the values are stored on the instance.
+        if self._lazy_fields:
+            self._nested_values = dict()
+        if self._related:
+            self._related_objects = dict()
+        self._client = None
+
         # TODO: go throuhg and create all items and fill them with data.
 
         # There is two ways to create the object. Either directly suing
@@ -132,15 +492,8 @@ class VismaModel(metaclass=VismaModelMeta):
 
     def _init_fields(self, kwargs=None):
 
-        for field_name, field_value in self.schema_fields.items():
-            try:
-                value = kwargs[field_name]
-            except KeyError:
-                value = field_value.default
-                if is_instance_or_subclass(value, _Missing):
-                    value = None
-
-            allow_none = field_value.allow_none or field_value.load_only
+        for field_name, default, allow_none in self._field_defaults:
+            value = kwargs.get(field_name, default)
 
             if value is None and not allow_none:
                 raise AttributeError(
@@ -149,30 +502,124 @@ class VismaModel(metaclass=VismaModelMeta):
 
             setattr(self, field_name, value)
 
+    def __setattr__(self, name, value):
+        if name in self._schema_items:
+            self._changed_fields.add(name)
+            # Forget the related object when the id referencing it changes.
+            related_name = self._related_fields.get(name)
+            if related_name is not None:
+                self._related_objects.pop(related_name, None)
+        super().__setattr__(name, value)
+
+    @property
+    def changed_fields(self):
+        """
+        Names of the fields that have been changed since the object was
+        loaded from the API. Nested values that are changed in place are
+        included when they differ from the loaded data. Nested values that
+        were not lazily loaded can't be compared and always count as changed.
+        """
+        changed = set(self._changed_fields)
+        for field_name, field in self._schema_items.items():
+            if field_name in changed or not _is_nested(field):
+                continue
+            if field_name in self._lazy_fields:
+                value = self._nested_values.get(field_name)
+                if not isinstance(value, LazyValue):
+                    if value is not None:
+                        changed.add(field_name)
+                elif value.loaded:
+                    # Compare with a fresh copy loaded from the raw JSON.
+                    dump = _get_dump_converter(field)
+                    if dump(value.value) != dump(value.convert(value.data)):
+                        changed.add(field_name)
+            elif getattr(self, field_name) is not None:
+                changed.add(field_name)
+        return changed
+
+    def _set_client(self, client):
+        """
+        Records the client the object was loaded with, so it is saved and its
+        related objects are fetched with the same client.
+        """
+        self._client = client
+
+    def _get_manager(self):
+        """
+        The manager of the model using the client the object was loaded with,
+        if it was loaded from the API.
+        """
+        manager = self.objects
+        if self._client is None or self._client is manager.api:
+            return manager
+        return manager.using(self._client)
+
     def _update_value(self, obj=None):
 
         if obj is None:
             return
 
         else:
-            for field_name, field_value in self.schema_fields.items():
+            for field_name in self._schema_items:
+                if field_name in self._lazy_fields:
+                    # Keep the raw JSON of nested values from the response.
+                    self._nested_values[field_name] = \
+                        obj._nested_values.get(field_name)
+                    continue
                 value = getattr(obj, field_name)
                 setattr(self, field_name, value)
 
-    def save(self):
+    def save(self, update_fields=None):
+        """
+        Create or update the object in Visma. Updates only send the fields
+        that have changed since the object was loaded, or the fields in
+        update_fields, and no request is made if nothing has changed.
+        """
 
         if self.id is None:
             # create a new model
-            new_obj = self.objects.create(self)
-            self._update_value(obj=new_obj)
+            new_obj = self._get_manager().create(self)
+            self._saved(new_obj)
 
         else:
+            update_fields = self._get_update_fields(update_fields)
+            if not update_fields:
+                logger.debug(f'No changes on {self!r}, skipping save')
+                self.objects.skipped_updates += 1
+                return
+
             # update model
-            updated_obj = self.objects.update(self)
-            self._update_value(obj=updated_obj)
+            updated_obj = self._get_manager().update(self,
+                                                     fields=update_fields)
+            self._saved(updated_obj)
+
+    def _get_update_fields(self, update_fields=None):
+        """
+        Returns the fields to send on update, the changed fields unless
+        update_fields is given.
+        """
+        if update_fields is None:
+            return self.changed_fields
+
+        update_fields = set(update_fields)
+        unknown_fields = update_fields - set(self._schema_items)
+        if unknown_fields:
+            raise ValueError(
+                f'{self.__class__.__name__} has no fields named '
+                f'{", ".join(sorted(unknown_fields))}')
+        return update_fields
+
+    def _saved(self, obj):
+        """
+        Updates the object with the one returned by the API after saving.
+        """
+        self._update_value(obj=obj)
+        self._changed_fields.clear()
+        if obj is not None and obj._client is not None:
+            self._client = obj._client
 
     def delete(self):
-        self.objects.delete(self.id)
+        self._get_manager().delete(self.id)
 
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self)
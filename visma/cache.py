@@ -0,0 +1,434 @@
+"""
+Caches for data that changes seldom.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache:
+    """
+    In memory cache of the data of the objects loaded by a manager, set up
+    with cache in the model Meta::
+
+        class Meta:
+            cache = {'ttl': 3600, 'max_entries': 100}
+
+    Entries expire ttl seconds after they were stored. When the cache holds
+    max_entries the least recently used entry is evicted, or the oldest one
+    with ``eviction='fifo'``.
+    """
+    EVICTION_POLICIES = ('lru', 'fifo')
+
+    def __init__(self, ttl=3600, max_entries=100, eviction='lru'):
+        if eviction not in self.EVICTION_POLICIES:
+            raise ValueError(
+                f'Unknown eviction policy {eviction}, use one of '
+                f'{", ".join(self.EVICTION_POLICIES)}')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    if self.eviction == 'lru':
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        Removes key from the cache, or all entries if no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+def get_client_key(api):
+    """
+    Part of the cache keys identifying the client, so tenants don't share
+    entries.
+    """
+    return getattr(api, 'tenant', None) or id(api)
+
+
+class CachedResponse:
+    """
+    A response read from the :class:`ResponseCache`. memo keeps the data
+    decoded from the content, see :func:`get_response_data`.
+    """
+    __slots__ = ('status_code', 'headers', 'content', 'expires', 'memo')
+
+    def __init__(self, status_code, headers, content, expires, memo=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.expires = expires
+        self.memo = dict() if memo is None else memo
+
+    @property
+    def fresh(self):
+        return self.expires > time.time()
+
+    @property
+    def validators(self):
+        """
+        Headers for a conditional request revalidating the response.
+        """
+        return get_validators(self.headers)
+
+
+def get_response_data(response):
+    """
+    Returns the decoded JSON of response. The content of a response served
+    from the response cache, also after a 304, is only decoded the first
+    time and the same data is returned after that. It is shared so it
+    shouldn't be changed, the objects loaded from it are new every time.
+    """
+    cached = getattr(response, 'cached', None)
+    if cached is None:
+        return response.json()
+    data = cached.memo.get('data')
+    if data is None:
+        data = cached.memo['data'] = response.json()
+    return data
+
+
+def get_validators(headers):
+    """
+    Returns If-None-Match and If-Modified-Since request headers from the
+    ETag and Last-Modified headers of a response.
+    """
+    validators = dict()
+    for name, value in headers.items():
+        name = name.lower()
+        if name == 'etag':
+            validators['If-None-Match'] = value
+        elif name == 'last-modified':
+            validators['If-Modified-Since'] = value
+    return validators
+
+
+class MemoryResponseCache:
+    """
+    In memory version of :class:`ResponseCache` for a single process,
+    keeping max_entries responses. With the default ttl of 0 the responses
+    are never used without revalidating them with a conditional request, so
+    only responses with an ETag or Last-Modified header are kept.
+    """
+
+    def __init__(self, ttl=0, max_entries=100):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tenant, endpoint, params=None, stale=False):
+        key = ResponseCache.get_key(tenant, endpoint, params)
+        with self._lock:
+            cached, _, _ = self._entries.get(key, (None, None, None))
+            if cached is not None and (stale or cached.fresh):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+            return None
+
+    def set(self, tenant, endpoint, params, status_code, headers, content):
+        headers = {name: value for name, value in headers.items()
+                   if name.lower() not in ResponseCache.SKIP_HEADERS}
+        if not self.ttl and not get_validators(headers):
+            return
+
+        key = ResponseCache.get_key(tenant, endpoint, params)
+        cached = CachedResponse(status_code, headers, content,
+                                time.time() + self.ttl)
+        with self._lock:
+            self._entries[key] = (cached, str(tenant),
+                                  ResponseCache.get_resource(endpoint))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def refresh(self, tenant, endpoint, params=None):
+        """
+        Marks the cached response as fresh again after the server responded
+        that it hasn't changed.
+        """
+        key = ResponseCache.get_key(tenant, endpoint, params)
+        with self._lock:
+            cached, _, _ = self._entries.get(key, (None, None, None))
+            if cached is not None:
+                cached.expires = time.time() + self.ttl
+            self.revalidations += 1
+
+    def invalidate(self, tenant=None, endpoint=None):
+        """
+        Removes the cached responses of the resource of endpoint for tenant,
+        or all responses if neither is given.
+        """
+        resource = None
+        if endpoint is not None:
+            resource = ResponseCache.get_resource(endpoint)
+        with self._lock:
+            for key, (_, entry_tenant, entry_resource) in list(
+                    self._entries.items()):
+                if ((tenant is None or entry_tenant == str(tenant)) and
+                        (resource is None or entry_resource == resource)):
+                    del self._entries[key]
+
+
+class ResponseCache:
+    """
+    Cache of GET responses in a SQLite database at path. Processes using the
+    same path share the cache, so short lived processes don't have to fetch
+    the same data again. Responses are keyed by tenant, endpoint and query
+    parameters.
+
+    Responses are kept for ttl seconds, or the seconds given for the endpoint
+    in endpoints, ex ``{'/companysettings': 3600}``. If endpoints is given
+    only those endpoints are cached. When the cached responses take up more
+    than max_size bytes the least recently used are removed.
+
+    Expired responses with an ETag or Last-Modified header are kept, so the
+    client can revalidate them with a conditional request instead of fetching
+    them again. They are the first to be removed when the cache is full.
+    """
+    # Response headers that don't apply to the cached content.
+    SKIP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding',
+                    'connection')
+    # Number of responses with validators to keep the decoded data of in
+    # memory, so revalidated responses aren't decoded again.
+    MEMO_ENTRIES = 100
+
+    def __init__(self, path, ttl=300, max_size=64 * 1024 * 1024,
+                 endpoints=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.endpoints = endpoints
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self._connection = None
+        self._pid = None
+        self._memos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_ttl(self, endpoint):
+        """
+        Seconds responses from endpoint are cached, or None if they aren't.
+        """
+        if self.endpoints is None:
+            return self.ttl
+        resource = self.get_resource(endpoint)
+        return self.endpoints.get(endpoint, self.endpoints.get(resource))
+
+    def get(self, tenant, endpoint, params=None, stale=False):
+        """
+        Returns the cached :class:`CachedResponse` or None. Expired responses
+        are only returned if stale is True.
+        """
+        if self.get_ttl(endpoint) is None:
+            return None
+
+        key = self.get_key(tenant, endpoint, params)
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                'SELECT status_code, headers, content, expires '
+                'FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and (stale or row[3] > time.time()):
+                connection.execute(
+                    'UPDATE responses SET accessed = ? WHERE key = ?',
+                    (time.time(), key))
+                self.hits += 1
+                headers = json.loads(row[1])
+                return CachedResponse(row[0], headers, row[2], row[3],
+                                      memo=self._get_memo(key, headers))
+            self.misses += 1
+            return None
+
+    def _get_memo(self, key, headers):
+        # The memo of a response is kept as long as its validators are the
+        # same, so the content hasn't changed.
+        validators = get_validators(headers)
+        if not validators:
+            return None
+        entry = self._memos.get(key)
+        if entry is None or entry[0] != validators:
+            entry = self._memos[key] = (validators, dict())
+        self._memos.move_to_end(key)
+        while len(self._memos) > self.MEMO_ENTRIES:
+            self._memos.popitem(last=False)
+        return entry[1]
+
+    def set(self, tenant, endpoint, params, status_code, headers, content):
+        """
+        Stores a response, if the endpoint is cached.
+        """
+        ttl = self.get_ttl(endpoint)
+        if ttl is None:
+            return
+
+        headers = {name: value for name, value in headers.items()
+                   if name.lower() not in self.SKIP_HEADERS}
+        key = self.get_key(tenant, endpoint, params)
+        now = time.time()
+        with self._lock:
+            self._memos.pop(key, None)
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute(
+                    'INSERT OR REPLACE INTO responses (key, tenant, resource, '
+                    'status_code, headers, content, size, expires, accessed, '
+                    'validated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, str(tenant), self.get_resource(endpoint),
+                     status_code, json.dumps(headers), content, len(content),
+                     now + ttl, now, bool(get_validators(headers))))
+                self._evict(connection)
+
+    def refresh(self, tenant, endpoint, params=None):
+        """
+        Marks the cached response as fresh again after the server responded
+        that it hasn't changed.
+        """
+        ttl = self.get_ttl(endpoint)
+        if ttl is None:
+            return
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                'UPDATE responses SET expires = ?, accessed = ? '
+                'WHERE key = ?',
+                (now + ttl, now, self.get_key(tenant, endpoint, params)))
+            self.revalidations += 1
+
+    def invalidate(self, tenant=None, endpoint=None):
+        """
+        Removes the cached responses of the resource of endpoint, ex all
+        /customers responses for /customers/{id}, for tenant. Removes all
+        responses if neither is given.
+        """
+        query = 'DELETE FROM responses'
+        conditions = []
+        args = []
+        if tenant is not None:
+            conditions.append('tenant = ?')
+            args.append(str(tenant))
+        if endpoint is not None:
+            conditions.append('resource = ?')
+            args.append(self.get_resource(endpoint))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+
+        with self._lock:
+            self._memos.clear()
+            connection = self._connect()
+            with connection:
+                connection.execute(query, args)
+
+    def _evict(self, connection):
+        # Expired responses are kept if they can be revalidated with a
+        # conditional request, until the cache is full.
+        connection.execute(
+            'DELETE FROM responses WHERE expires < ? AND NOT validated',
+            (time.time(),))
+        total_size = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        evict = []
+        for key, size in connection.execute(
+                'SELECT key, size FROM responses '
+                'ORDER BY expires > ?, accessed', (time.time(),)):
+            if total_size <= self.max_size:
+                break
+            evict.append((key,))
+            total_size -= size
+        connection.executemany('DELETE FROM responses WHERE key = ?', evict)
+        self.evictions += len(evict)
+        logger.debug(f'Evicted {len(evict)} responses from {self.path}')
+
+    def _connect(self):
+        # A connection can't be shared with a forked process, so a new one
+        # is opened in every process.
+        pid = os.getpid()
+        if self._connection is None or self._pid != pid:
+            # Imported here so it isn't loaded unless a cache on disk is
+            # used.
+            import sqlite3
+
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, tenant TEXT, resource TEXT, '
+                'status_code INTEGER, headers TEXT, content BLOB, '
+                'size INTEGER, expires REAL, accessed REAL, '
+                'validated INTEGER)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed '
+                'ON responses (accessed)')
+            self._connection = connection
+            self._pid = pid
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def get_key(tenant, endpoint, params=None):
+        params = sorted((params or dict()).items())
+        key = json.dumps([str(tenant), endpoint, params], default=str)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    @staticmethod
+    def get_resource(endpoint):
+        return '/' + endpoint.strip('/').split('/')[0]
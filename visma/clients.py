@@ -0,0 +1,187 @@
+"""
+Registry of the API clients used by the model managers.
+
+All managers share the same client, so they share its connection pool, rate
+limiter and tokens. By default it is the API class in the VISMA_API_CLASS
+environment variable, loaded the first time it is needed. Other clients, for
+example one per tenant, can be registered by name and bound with
+:func:`tenant`::
+
+    register_client(VismaAPI.load(), name='acme')
+
+    with tenant('acme'):
+        customers = list(Customer.objects.all())
+
+When serving many companies from one process a :class:`TenantPool` creates
+the clients when they are needed and keeps the most recently used ones.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from visma.utils import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLIENT = 'default'
+
+_clients = dict()
+_clients_lock = threading.Lock()
+_current_client = ContextVar('visma_current_client', default=None)
+
+
+def load_client():
+    """
+    Loads the API class set in the VISMA_API_CLASS environment variable.
+    """
+    api_klass_path = os.environ.get('VISMA_API_CLASS',
+                                    default='visma.api.NoAPI')
+    logger.debug(f'Loading API {api_klass_path}')
+    return import_string(api_klass_path).load()
+
+
+def register_client(client, name=DEFAULT_CLIENT):
+    """
+    Registers client under name. Registering the default client replaces the
+    one used by all managers.
+    """
+    with _clients_lock:
+        _clients[name] = client
+    return client
+
+
+def unregister_client(name=DEFAULT_CLIENT):
+    with _clients_lock:
+        return _clients.pop(name, None)
+
+
+def get_client(name=DEFAULT_CLIENT):
+    """
+    Returns the client registered under name. The default client is loaded
+    with :func:`load_client` the first time it is asked for.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                if name != DEFAULT_CLIENT:
+                    raise KeyError(f'No client registered as {name}')
+                client = load_client()
+                _clients[name] = client
+    return client
+
+
+def get_current_client():
+    """
+    Returns the client bound with :func:`tenant`, or None.
+    """
+    return _current_client.get()
+
+
+@contextmanager
+def tenant(client):
+    """
+    Binds client, or the client registered under that name, for all managers
+    in the block. The binding is local to the thread or asyncio task.
+    Querysets use the client that was bound when they were created.
+    """
+    if isinstance(client, str):
+        client = get_client(client)
+    token = _current_client.set(client)
+    try:
+        yield client
+    finally:
+        _current_client.reset(token)
+
+
+class TenantPool:
+    """
+    Keeps the clients of up to max_size tenants, so their tokens and
+    connection pools are reused between requests. Clients are created with
+    factory(tenant_name) when first needed, and the least recently used
+    client is closed and dropped when the pool is full::
+
+        pool = TenantPool(
+            lambda name: VismaAPI.load(token_path=f'/tokens/{name}.json'))
+
+        with pool.tenant('acme'):
+            customers = list(Customer.objects.all())
+    """
+
+    def __init__(self, factory, max_size=100):
+        self.factory = factory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __contains__(self, name):
+        return name in self._clients
+
+    def get(self, name):
+        """
+        Returns the client of the tenant, creating it if needed.
+        """
+        with self._lock:
+            client = self._clients.get(name)
+            if client is not None:
+                self._clients.move_to_end(name)
+                self.hits += 1
+                return client
+
+        # Create the client outside the lock since it may read files or make
+        # requests. If another thread got there first its client is used.
+        new_client = self.factory(name)
+        with self._lock:
+            client = self._clients.setdefault(name, new_client)
+            self._clients.move_to_end(name)
+            if client is not new_client:
+                self.hits += 1
+                return client
+            self.misses += 1
+            evicted = []
+            while len(self._clients) > self.max_size:
+                evicted.append(self._clients.popitem(last=False))
+                self.evictions += 1
+
+        for evicted_name, evicted_client in evicted:
+            logger.debug(f'Evicting client of tenant {evicted_name}')
+            self._close(evicted_client)
+        return client
+
+    def evict(self, name):
+        """
+        Closes and drops the client of the tenant, if it is in the pool.
+        """
+        with self._lock:
+            client = self._clients.pop(name, None)
+        if client is not None:
+            self._close(client)
+
+    def clear(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            self._close(client)
+
+    def tenant(self, name):
+        """
+        Binds the client of the tenant with :func:`tenant`.
+        """
+        return tenant(self.get(name))
+
+    @staticmethod
+    def _close(client):
+        close = getattr(client, 'close', None)
+        if close is not None:
+            close()
@@ -1,23 +1,107 @@
+import copy
+import datetime
 import json
 import logging
+from contextvars import copy_context
 
-from visma.api import VismaClientException
+from visma.api import VismaAPIException, VismaClientException
+from visma.cache import get_client_key, get_response_data
+from visma.clients import get_client, get_current_client
 from visma.query import APIQuerySet
+from visma.sync import as_utc
 
 logger = logging.getLogger(__name__)
 
 
+class BulkResult:
+    """
+    The outcome for one object in a bulk operation. result is what the API
+    returned and error the exception raised, if the request failed.
+    """
+    __slots__ = ('obj', 'result', 'error')
+
+    def __init__(self, obj, result=None, error=None):
+        self.obj = obj
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        status = 'ok' if self.ok else f'error={self.error!r}'
+        return f'<BulkResult: {self.obj!r} {status}>'
+
+
+def _is_not_found(error):
+    return isinstance(error, VismaAPIException) and 'HTTP:404' in str(error)
+
+
 class Manager:
+    # Number of requests made at the same time by the bulk methods.
+    BULK_CONCURRENCY = 4
+    # Number of ids fetched per request by in_bulk.
+    IN_BULK_BATCH_SIZE = 50
+    # Fields with the time of the last change on an object, used by
+    # changed_since() unless changed_field is set in the model Meta.
+    CHANGED_FIELDS = ('changed_utc', 'modified_utc')
+    # Objects changed this long before the watermark are fetched again by
+    # sync, in case they were saved after the last sync with an earlier time.
+    SYNC_OVERLAP = datetime.timedelta(seconds=5)
+    # Number of objects fetched per request by sync.
+    SYNC_BATCH_SIZE = 500
 
     def __init__(self):
         self.model = None
         self.name = None
         self.endpoint = None
-        self.api = None
+        self._api = None
+        self._using = None
         self.allowed_methods = list()
         self.schema = None
         self._schema = None
         self.envelopes = dict()
+        # Size in bytes of the payloads sent on create and update, and the
+        # number of saves skipped since nothing had changed.
+        self.payload_bytes = 0
+        self.skipped_updates = 0
+        # ModelCache set up with cache in the model Meta.
+        self.cache = None
+        # Field with the time of the last change, set with changed_field in
+        # the model Meta.
+        self.changed_field = None
+
+    @property
+    def api(self):
+        """
+        The client given to :meth:`using`, else the client bound with
+        :func:`visma.tenant`, else the client set on the manager, else the
+        shared default client.
+        """
+        if self._using is not None:
+            return self._using
+        client = get_current_client()
+        if client is not None:
+            return client
+        if self._api is not None:
+            return self._api
+        return get_client()
+
+    @api.setter
+    def api(self, api):
+        self._api = api
+
+    def using(self, client):
+        """
+        Returns a copy of the manager that makes its requests with client, or
+        the client registered under that name.
+        """
+        if isinstance(client, str):
+            client = get_client(client)
+        manager = copy.copy(self)
+        manager._using = client
+        return manager
 
     def register_model(self, model, name):
         self.name = self.name or name
@@ -39,6 +123,41 @@ class Manager:
     def use_envelope(self, method):
         return method in self.envelopes.keys()
 
+    @property
+    def can_list(self):
+        return 'LIST' in self.allowed_methods and self.use_envelope('LIST')
+
+    def invalidate_cache(self):
+        """
+        Removes all cached objects of the model, if it is cached.
+        """
+        if self.cache is not None:
+            self.cache.invalidate()
+
+    def _get_payload(self, obj, fields=None):
+        """
+        Dumps obj, or only the given fields of it, to the JSON sent to the
+        API.
+        """
+        out_data = self.schema.dump_model(obj, only=fields)
+        payload = json.dumps(out_data)
+        self.payload_bytes += len(payload)
+        logger.debug(f'Sending {len(payload)} bytes: {out_data}')
+        return payload
+
+    def _load(self, data, api):
+        """
+        Loads an object from the JSON returned by api, which is kept on the
+        object to save it and fetch its related objects with.
+        """
+        obj = self.schema.load_model(data)
+        obj._set_client(api)
+        return obj
+
+    def _get_cache_key(self, api, pk):
+        # The same for get and aget, so they share cached objects.
+        return (get_client_key(api), 'get', str(pk))
+
     def _get_query_set(self, *args, **kwargs):
         return APIQuerySet(model=self.model, api=self.api, schema=self.schema,
                            *args, **kwargs)
@@ -59,42 +178,317 @@ class Manager:
         return self._get_query_set(envelope=self.envelopes['LIST']).exclude(
             **kwargs)
 
+    def bulk_create(self, objs, concurrency=None, method='CREATE'):
+        """
+        Creates the objects with up to concurrency requests at the same time.
+        The objects are updated with the data returned like on .save().
+        Returns a :class:`BulkResult` for each object, in the same order. A
+        failing request doesn't stop the others.
+        """
+        self.verify_method(method)
+
+        def create(obj):
+            new_obj = self.create(obj)
+            obj._saved(new_obj)
+            return new_obj
+
+        return self._bulk(create, objs, concurrency)
+
+    def bulk_update(self, objs, update_fields=None, concurrency=None,
+                    method='UPDATE'):
+        """
+        Updates the objects like .save(update_fields) with up to concurrency
+        requests at the same time. Objects without changes are skipped and
+        get a result of None. Returns a :class:`BulkResult` for each object.
+        """
+        self.verify_method(method)
+
+        def update(obj):
+            fields = obj._get_update_fields(update_fields)
+            if not fields:
+                self.skipped_updates += 1
+                return None
+            updated_obj = self.update(obj, fields=fields)
+            obj._saved(updated_obj)
+            return updated_obj
+
+        return self._bulk(update, objs, concurrency)
+
+    def bulk_delete(self, objs, concurrency=None, method='DELETE'):
+        """
+        Deletes the objects, or primary keys, with up to concurrency requests
+        at the same time. Returns a :class:`BulkResult` for each object.
+        """
+        self.verify_method(method)
+
+        def delete(obj):
+            return self.delete(getattr(obj, 'id', obj))
+
+        return self._bulk(delete, objs, concurrency)
+
+    def in_bulk(self, pks, batch_size=None, concurrency=None):
+        """
+        Returns a dict of the objects with the given primary keys, by id.
+        Objects that don't exist are left out. If the model can be listed the
+        objects are fetched batch_size at a time with an id__in filter,
+        otherwise with a get per object with up to concurrency requests at
+        the same time.
+        """
+        pks = list(pks)
+        objs = dict()
+        if self.can_list:
+            batch_size = batch_size or self.IN_BULK_BATCH_SIZE
+            for start in range(0, len(pks), batch_size):
+                batch = pks[start:start + batch_size]
+                for obj in self.filter(id__in=batch).page_size(len(batch)):
+                    objs[obj.id] = obj
+            return objs
+
+        for result in self._bulk(self.get, pks, concurrency):
+            if result.ok:
+                objs[result.obj] = result.result
+            elif not _is_not_found(result.error):
+                raise result.error
+        return objs
+
+    async def ain_bulk(self, pks, batch_size=None, concurrency=None):
+        """
+        Async version of :meth:`in_bulk`. The gets of models that can't be
+        listed run as tasks on the running event loop.
+        """
+        import asyncio
+
+        pks = list(pks)
+        objs = dict()
+        if self.can_list:
+            batch_size = batch_size or self.IN_BULK_BATCH_SIZE
+            for start in range(0, len(pks), batch_size):
+                batch = pks[start:start + batch_size]
+                async for obj in self.filter(id__in=batch).page_size(
+                        len(batch)):
+                    objs[obj.id] = obj
+            return objs
+
+        concurrency = concurrency or self.BULK_CONCURRENCY
+        for start in range(0, len(pks), concurrency):
+            batch = pks[start:start + concurrency]
+            results = await asyncio.gather(
+                *(self.aget(pk) for pk in batch), return_exceptions=True)
+            for pk, result in zip(batch, results):
+                if not isinstance(result, Exception):
+                    objs[pk] = result
+                elif not _is_not_found(result):
+                    raise result
+        return objs
+
+    def _bulk(self, func, objs, concurrency=None):
+        def run(obj):
+            try:
+                return BulkResult(obj, result=func(obj))
+            except Exception as e:
+                logger.debug(f'Bulk operation failed on {obj!r}: {e}')
+                return BulkResult(obj, error=e)
+
+        concurrency = concurrency or self.BULK_CONCURRENCY
+        if concurrency == 1:
+            return [run(obj) for obj in objs]
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Run every request in a copy of the current context so a client
+        # bound with visma.tenant() is used in the worker threads too.
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(copy_context().run, run, obj)
+                       for obj in objs]
+            return [future.result() for future in futures]
+
+    def get_changed_field(self):
+        field_name = self.changed_field
+        if field_name is None:
+            for name in self.CHANGED_FIELDS:
+                if name in self.model._schema_items:
+                    field_name = name
+                    break
+        if field_name is None:
+            raise VismaClientException(
+                f'{self.model.__name__} has no field with the time of the '
+                f'last change')
+        return field_name
+
+    def changed_since(self, since):
+        """
+        Returns a queryset of the objects changed after since.
+        """
+        return self.filter(**{f'{self.get_changed_field()}__gt': since})
+
+    def sync(self, store, since=None):
+        """
+        Yields the objects changed since the last sync, or since the given
+        time the first time, and all objects if neither is known. The time of
+        the latest change seen is saved in store, a
+        :class:`visma.sync.WatermarkStore`, when all objects have been
+        iterated over, so the next sync starts from there.
+
+        The objects are fetched in order of their time of change, batch by
+        batch from the time of the last object of the previous batch, so
+        objects changed during the sync aren't skipped. The next sync starts
+        SYNC_OVERLAP before the watermark and skips the objects the last one
+        yielded, by id and time of change.
+        """
+        field_name = self.get_changed_field()
+        name = self.model.__name__
+        tenant = getattr(self.api, 'tenant', None) or 'default'
+        watermark = store.get(name, tenant)
+        if watermark is None:
+            seen = set()
+            watermark = as_utc(since)
+        else:
+            seen = store.get_seen(name, tenant)
+        cursor = None if watermark is None else watermark - self.SYNC_OVERLAP
+        logger.debug(f'Syncing {name} changed since {cursor}')
+
+        batch_size = self.SYNC_BATCH_SIZE
+        while True:
+            if cursor is None:
+                queryset = self.all()
+            else:
+                queryset = self.filter(**{f'{field_name}__gte': cursor})
+            objs = queryset.order_by(field_name)[:batch_size]
+
+            for obj in objs:
+                # Compared in UTC without time zone, like the watermark.
+                changed = as_utc(getattr(obj, field_name))
+                key = (str(obj.id), changed)
+                if key in seen:
+                    continue
+                seen.add(key)
+                if changed is not None and (watermark is None or
+                                            changed > watermark):
+                    watermark = changed
+                yield obj
+
+            if len(objs) < batch_size:
+                break
+            last = as_utc(getattr(objs[-1], field_name))
+            if last is None or last == cursor:
+                # The whole batch changed at the same time, so fetch more
+                # objects at once to get past it.
+                batch_size *= 2
+            else:
+                cursor = last
+                batch_size = self.SYNC_BATCH_SIZE
+
+        if watermark is not None:
+            overlap_start = watermark - self.SYNC_OVERLAP
+            store.set(name, tenant, watermark,
+                      seen=[(pk, changed) for pk, changed in seen
+                            if changed is not None and
+                            changed >= overlap_start])
+
     # TODO: Should get, create update and delete also return querysets?
     # Then need to implement the handling of them
 
     def get(self, pk, method='GET'):
         self.verify_method(method)
+        api = self.api
+        if self.cache is not None:
+            # The data is cached, so every get returns a new object.
+            cache_key = self._get_cache_key(api, pk)
+            data = self.cache.get(cache_key)
+            if data is not None:
+                return self._load(data, api)
+
         _endpoint = f'{self.endpoint}/{pk}'
-        data = self.api.get(_endpoint).json()
+        data = get_response_data(api.get(_endpoint))
         logger.debug(f'Received: {data}')
-        obj = self.schema.load(data)
+        obj = self._load(data, api)
+
+        if self.cache is not None:
+            self.cache.set(cache_key, data)
         return obj
 
     def create(self, obj, method='CREATE'):
         self.verify_method(method)
-        out_data = self.schema.dump(obj)
-        logger.debug(f'Sending: {out_data}')
-        result = self.api.post(self.endpoint, json.dumps(out_data))
+        self.invalidate_cache()
+        api = self.api
+        payload = self._get_payload(obj)
+        result = api.post(self.endpoint, payload)
         in_data = result.json()
         logger.debug(f'Received {in_data}')
-        new_obj = self.schema.load(in_data)
+        new_obj = self._load(in_data, api)
         return new_obj
 
-    def update(self, obj, method='UPDATE'):
+    def update(self, obj, method='UPDATE', fields=None):
         self.verify_method(method)
+        self.invalidate_cache()
+        api = self.api
         pk = obj.id
         _endpoint = f'{self.endpoint}/{pk}'
-        out_data = self.schema.dump(obj)
-        logger.debug(f'Sending {out_data}')
-        result = self.api.put(_endpoint, json.dumps(out_data))
+        payload = self._get_payload(obj, fields=fields)
+        result = api.put(_endpoint, payload)
         in_data = result.json()
         logger.debug(f'Received {in_data}')
-        updated_obj = self.schema.load(in_data)
+        updated_obj = self._load(in_data, api)
         return updated_obj
 
     def delete(self, pk, method='DELETE'):
         self.verify_method(method)
+        self.invalidate_cache()
         _endpoint = f'{self.endpoint}/{pk}'
         logger.debug(f'Deleting object at: {_endpoint}')
         result = self.api.delete(_endpoint)
         return result
+
+    async def aget(self, pk, method='GET'):
+        """Async version of :meth:`get`."""
+        self.verify_method(method)
+        api = self.api
+        if self.cache is not None:
+            # The data is cached, so every get returns a new object.
+            cache_key = self._get_cache_key(api, pk)
+            data = self.cache.get(cache_key)
+            if data is not None:
+                return self._load(data, api)
+
+        _endpoint = f'{self.endpoint}/{pk}'
+        data = get_response_data(await api.get(_endpoint))
+        logger.debug(f'Received: {data}')
+        obj = self._load(data, api)
+
+        if self.cache is not None:
+            self.cache.set(cache_key, data)
+        return obj
+
+    async def acreate(self, obj, method='CREATE'):
+        """Async version of :meth:`create`."""
+        self.verify_method(method)
+        self.invalidate_cache()
+        api = self.api
+        payload = self._get_payload(obj)
+        result = await api.post(self.endpoint, payload)
+        in_data = result.json()
+        logger.debug(f'Received {in_data}')
+        new_obj = self._load(in_data, api)
+        return new_obj
+
+    async def aupdate(self, obj, method='UPDATE', fields=None):
+        """Async version of :meth:`update`."""
+        self.verify_method(method)
+        self.invalidate_cache()
+        api = self.api
+        pk = obj.id
+        _endpoint = f'{self.endpoint}/{pk}'
+        payload = self._get_payload(obj, fields=fields)
+        result = await api.put(_endpoint, payload)
+        in_data = result.json()
+        logger.debug(f'Received {in_data}')
+        updated_obj = self._load(in_data, api)
+        return updated_obj
+
+    async def adelete(self, pk, method='DELETE'):
+        """Async version of :meth:`delete`."""
+        self.verify_method(method)
+        self.invalidate_cache()
+        _endpoint = f'{self.endpoint}/{pk}'
+        logger.debug(f'Deleting object at: {_endpoint}')
+        result = await self.api.delete(_endpoint)
+        return result
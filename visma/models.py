@@ -371,6 +371,7 @@ class TermsOfPayment(VismaModel):
     class Meta:
         endpoint = '/termsofpayments'
         allowed_methods = ['list', 'get']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
 
@@ -639,6 +640,7 @@ class CustomerInvoiceDraft(VismaModel):
         endpoint = '/customerinvoicedrafts'
         allowed_methods = ['list', 'get', 'create', 'update', 'delete']
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
+        related = {'customer': ('customer_id', 'Customer')}
 
 
 class CustomerInvoiceDraftRow(VismaModel):
@@ -743,6 +745,16 @@ class CustomerInvoiceDraftRow(VismaModel):
     unit_name = fields.String(data_key='UnitName', allow_none=True)
     project_id = fields.UUID(data_key='ProjectId', allow_none=True)
 
+    class Meta:
+        # No endpoint
+        related = {
+            'article': ('article_id', 'Article'),
+            'project': ('project_id', 'Project'),
+            'cost_center_item1': ('cost_center_item_id1', 'CostCenterItem'),
+            'cost_center_item2': ('cost_center_item_id2', 'CostCenterItem'),
+            'cost_center_item3': ('cost_center_item_id3', 'CostCenterItem'),
+        }
+
     def __str__(self):
         return '%s object (%s)' % (self.__class__.__name__, self.line_number)
 
@@ -837,6 +849,7 @@ class VatCode(VismaModel):
         # GET /v2/vatcodes/{id} Get a vat code item by it's id
         endpoint = '/vatcodes'
         allowed_methods = ['list', 'get']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
     # TODO: remove the need to add schema into nested fields.
@@ -986,6 +999,7 @@ class AccountType(VismaModel):
         #  Netherlands
         endpoint = '/accounttypes'
         allowed_methods = ['list']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
 
@@ -1379,6 +1393,7 @@ class Bank(VismaModel):
         # Get banks.
         endpoint = '/banks'
         allowed_methods = ['list']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
 
@@ -1718,6 +1733,7 @@ class Country(VismaModel):
         # GET /v2/countries/{countrycode} Get a single country.
         endpoint = '/countries'
         allowed_methods = ['list']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
         # TODO: need functionality to set other attribute to primary key to enable get
@@ -1743,6 +1759,7 @@ class Currency(VismaModel):
         # GET /v2/currencies Get a list of Currencies
         endpoint = '/currencies'
         allowed_methods = ['list']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
 
@@ -1814,6 +1831,7 @@ class DeliveryMethod(VismaModel):
         # Get a delivery method.
         endpoint = '/deliverymethods'
         allowed_methods = ['list', 'get']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
 
@@ -1844,6 +1862,7 @@ class DeliveryTerm(VismaModel):
         # Get single delivery term
         endpoint = '/deliveryterms'
         allowed_methods = ['list', 'get']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
 
@@ -2142,6 +2161,7 @@ class Unit(VismaModel):
         # GET /v2/units/{id} Get a single unit.
         endpoint = '/units'
         allowed_methods = ['list', 'get']
+        cache = {'ttl': 3600, 'max_entries': 100}
         envelopes = {'list': {'class': PaginatedResponse, 'data_attr': 'Data'}}
 
 
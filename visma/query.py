@@ -1,8 +1,17 @@
+import copy
+import datetime
 import json
+import logging
+import math
 import uuid
+from collections import deque
+from itertools import islice
 
 from marshmallow import fields
 
+from visma.cache import get_client_key, get_response_data
+from visma.clients import get_client
+
 """
 THe aim of the query module is to enable adding query parameters to our API Calls
 In the Visma API they use OData parameters to enable extensive filtering.
@@ -50,6 +59,11 @@ same as:
 
 REPR_OUTPUT_SIZE = 10
 
+logger = logging.getLogger(__name__)
+
+# Number of ids fetched per request by prefetch_related.
+PREFETCH_BATCH_SIZE = 50
+
 
 class QueryParam:
 
@@ -58,61 +72,621 @@ class QueryParam:
         self.value = value
 
 
+class AdaptivePageSize:
+    """
+    Keeps track of the page size to use for an endpoint. The page size is
+    doubled while responses are well within the latency and payload limits
+    and halved when a response goes over a limit or a request times out.
+
+    The page sizes used and how the responses turned out are kept in
+    ``history`` as tuples of (page_size, latency, payload_size).
+    """
+    HISTORY_SIZE = 100
+
+    def __init__(self, page_size, max_page_size, max_latency, max_payload,
+                 min_page_size=1):
+        self.page_size = page_size
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.max_latency = max_latency
+        self.max_payload = max_payload
+        self.history = deque(maxlen=self.HISTORY_SIZE)
+
+    def record(self, page_size, latency, payload_size):
+        self.history.append((page_size, latency, payload_size))
+
+        if latency > self.max_latency or payload_size > self.max_payload:
+            self.page_size = max(page_size // 2, self.min_page_size)
+        elif (latency < self.max_latency / 2 and
+              payload_size < self.max_payload / 2):
+            self.page_size = min(page_size * 2, self.max_page_size)
+
+        logger.debug(f'Page size {page_size} took {latency:.3f}s for '
+                     f'{payload_size} bytes. Next page size {self.page_size}')
+
+    def timed_out(self, page_size):
+        """
+        Shrinks the page size after a timeout. Returns False if the page size
+        can't get any smaller.
+        """
+        self.history.append((page_size, None, None))
+        if page_size <= self.min_page_size:
+            return False
+        self.page_size = max(page_size // 2, self.min_page_size)
+        logger.debug(f'Page size {page_size} timed out. '
+                     f'Next page size {self.page_size}')
+        return True
+
+
 class APIModelIterable:
     PAGINATION_PAGE_SIZE = 50
+    # Largest page size the API will return.
+    MAX_PAGE_SIZE = 1000
 
-    # TODO: Env variable?
-    # TODO: We neeed a way to limit the response size. We dont want to iterate over all pages all the time.
+    # The results share data with the pages they are loaded from, so pages
+    # from the model cache are copied before they are loaded.
+    copy_cached_pages = False
 
-    def __init__(self, queryset):
+    def __init__(self, queryset, chunk_size=None):
         self.queryset = queryset
+        self.page_size = chunk_size or queryset.query.page_size
+        self.page_sizer = None
+        self.query_params = None
+
+        api = queryset.api
+        if (self.page_size is None and queryset.envelope and
+                getattr(api, 'adaptive_page_size', False)):
+            self.page_sizer = self.get_page_sizer()
+
+        self.page_size = (self.page_size or
+                          getattr(queryset.model.Meta, 'page_size', None) or
+                          getattr(api, 'page_size', None) or
+                          self.PAGINATION_PAGE_SIZE)
+
+    def get_page_sizer(self):
+        """
+        The adaptive page size of the endpoint. It is kept on the API object
+        so what has been learned about an endpoint is used for later queries.
+        """
+        api = self.queryset.api
+        endpoint = self.queryset.model.Meta.endpoint
+        page_size = (getattr(self.queryset.model.Meta, 'page_size', None) or
+                     api.page_size or self.PAGINATION_PAGE_SIZE)
+        return api.page_sizers.setdefault(
+            endpoint, AdaptivePageSize(page_size,
+                                       max_page_size=self.MAX_PAGE_SIZE,
+                                       max_latency=api.max_page_latency,
+                                       max_payload=api.max_page_payload))
 
     def __iter__(self):
+        return self.load_pages(self.pages())
+
+    def load_pages(self, pages):
+        """
+        Yields the objects loaded from pages, the raw result data of each
+        page, with their related objects prefetched.
+        """
+        lookups = self.queryset._prefetch_related_lookups
+        # Related objects already fetched for earlier pages.
+        fetched = dict()
+        for result_data in pages:
+            objs = self.load_page(result_data)
+            if lookups:
+                self.prefetch_related(objs, lookups, fetched)
+            yield from objs
+
+    def prefetch_related(self, objs, lookups, fetched):
         queryset = self.queryset
-        compiler = self.queryset.query.query_compiler(queryset.query)
-        compiler.compile()
-        endpoint = queryset.model.Meta.endpoint
+        requests, saved = prefetch_related_objects(objs, lookups,
+                                                   api=queryset.api,
+                                                   fetched=fetched)
+        queryset.prefetch_requests += requests
+        queryset.prefetch_requests_saved += saved
+
+    async def aprefetch_related(self, objs, lookups, fetched):
+        """
+        Async version of :meth:`prefetch_related`.
+        """
+        queryset = self.queryset
+        requests, saved = await aprefetch_related_objects(
+            objs, lookups, api=queryset.api, fetched=fetched)
+        queryset.prefetch_requests += requests
+        queryset.prefetch_requests_saved += saved
 
-        query_params = compiler.get_query_params()
-        paginate = True
+    def load_page(self, result_data):
+        queryset = self.queryset
+        if queryset.envelope:
+            objs = queryset.envelope.load_model(result_data).data
+        else:
+            objs = [queryset.schema.load_model(result_data)]
+        # Related objects are fetched with the client of the queryset.
+        for obj in objs:
+            obj._set_client(queryset.api)
+        return objs
 
-        current_page = 1
-        total_number_of_pages = None
-        while paginate:
+    def pages(self):
+        """
+        Yields the raw result data of each page in page order.
 
-            query_params.update({'$pagesize': self.PAGINATION_PAGE_SIZE,
-                                 '$page': current_page})
+        Limits set on the query by slicing are translated to the pages that
+        cover them and the rows outside the limits are removed before the
+        page is yielded, so qs[:10] only needs a single request.
 
-            api_result = queryset.api.get(endpoint, params=query_params)
+        The first page is always fetched on its own since we don't know the
+        total number of pages until we have it. If the API allows concurrent
+        page fetching the remaining pages are fetched over a bounded pool of
+        workers.
+        """
+        queryset = self.queryset
+        self.query_params = self.compile_query_params()
 
-            result_data = api_result.json()
+        if not queryset.envelope:
+            yield self.fetch_page(1, self.page_size)
+            return
 
-            # TODO: Handle pagination. Give control via iterator function as in
-            # django
+        if self.is_empty():
+            return
 
-            if queryset.envelope:
+        if self.page_sizer is not None and queryset.query.high_mark is None:
+            yield from self.adaptive_pages()
+            return
 
-                result = queryset.envelope.load(result_data)
-                meta = result.meta
-                total_number_of_pages = meta.total_number_of_pages
+        page_size, first_page, last_page = self.get_page_range()
+        result_data = self.fetch_page(first_page, page_size)
+        last_page = self.get_last_page(result_data, last_page)
 
-                objs = result.data
+        yield self.trim_page(result_data, first_page, page_size)
 
-                for obj in objs:
-                    yield obj
+        remaining_pages = range(first_page + 1, last_page + 1)
 
-            else:
-                paginate = False
-                obj = queryset.schema.load(data=result_data)
+        max_workers = getattr(queryset.api, 'max_concurrent_pages', 1)
+        if max_workers > 1 and len(remaining_pages) > 1:
+            pages = self.fetch_pages_concurrently(remaining_pages, page_size,
+                                                  max_workers)
+        else:
+            pages = (self.fetch_page(page, page_size)
+                     for page in remaining_pages)
+
+        for page, result_data in zip(remaining_pages, pages):
+            yield self.trim_page(result_data, page, page_size)
+
+    def is_empty(self):
+        query = self.queryset.query
+        return query.high_mark is not None and query.high_mark <= query.low_mark
+
+    def get_page_range(self):
+        """
+        Returns the page size, first page and last page (None if not known
+        before the first page is fetched) to fetch for the query limits.
+        """
+        low_mark = self.queryset.query.low_mark
+        high_mark = self.queryset.query.high_mark
+
+        page_size = self.page_size
+        last_page = None
+        if high_mark is not None:
+            page_size = (self.get_aligned_page_size(low_mark, high_mark) or
+                         page_size)
+            last_page = (high_mark - 1) // page_size + 1
+
+        first_page = low_mark // page_size + 1
+        return page_size, first_page, last_page
+
+    def get_last_page(self, result_data, last_page):
+        total_number_of_pages = (
+            self.get_total_number_of_pages(result_data) or 1)
+        if last_page is None or last_page > total_number_of_pages:
+            return total_number_of_pages
+        return last_page
+
+    def adaptive_pages(self):
+        """
+        Yields pages sequentially with the page size chosen by the page sizer.
+        Since the page number depends on the page size a new page size is only
+        used when the current offset is on a page boundary for it.
+        """
+        page_sizer = self.page_sizer
+        timeout_exceptions = getattr(self.queryset.api, 'TIMEOUT_EXCEPTIONS',
+                                     ())
+        offset = self.queryset.query.low_mark
+        page_size = None
+
+        while True:
+            if page_size is None or offset % page_sizer.page_size == 0:
+                page_size = page_sizer.page_size
+            page = offset // page_size + 1
+
+            try:
+                # Timeouts are not retried with the same page size, they
+                # make the page size smaller.
+                api_result = self.get_page_response(page, page_size,
+                                                    retry_timeouts=False)
+            except timeout_exceptions:
+                if not page_sizer.timed_out(page_size):
+                    raise
+                # Use the smaller page size right away even if it isn't on
+                # a page boundary. The rows before the offset are trimmed.
+                page_size = None
+                continue
+
+            # Only the time of the HTTP request itself counts, not waiting
+            # for the rate limiter or retries.
+            page_sizer.record(page_size, api_result.elapsed.total_seconds(),
+                              len(api_result.content))
+            result_data = get_response_data(api_result)
+            total_number_of_results = (
+                self.get_meta(result_data).total_number_of_results or 0)
+
+            yield self.trim_page(result_data, page, page_size, offset)
+
+            offset = page * page_size
+            if offset >= total_number_of_results:
+                break
+
+    def __aiter__(self):
+        return self.aload_pages(self.apages())
+
+    async def aload_pages(self, pages):
+        """
+        Async version of :meth:`load_pages`, pages being an async iterable.
+        """
+        lookups = self.queryset._prefetch_related_lookups
+        fetched = dict()
+        async for result_data in pages:
+            objs = self.load_page(result_data)
+            if lookups:
+                await self.aprefetch_related(objs, lookups, fetched)
+            for obj in objs:
                 yield obj
 
+    async def apages(self):
+        """
+        Async version of :meth:`pages`. Concurrent pages are fetched as tasks
+        on the running event loop. The adaptive page size is not used.
+        """
+        import asyncio
+
+        queryset = self.queryset
+        self.query_params = self.compile_query_params()
+
+        if not queryset.envelope:
+            yield await self.afetch_page(1, self.page_size)
+            return
+
+        if self.is_empty():
+            return
+
+        page_size, first_page, last_page = self.get_page_range()
+        result_data = await self.afetch_page(first_page, page_size)
+        last_page = self.get_last_page(result_data, last_page)
+
+        yield self.trim_page(result_data, first_page, page_size)
+
+        remaining_pages = iter(range(first_page + 1, last_page + 1))
+        max_workers = getattr(queryset.api, 'max_concurrent_pages', 1)
+        pending = deque()
+        try:
+            for page in islice(remaining_pages, max_workers):
+                pending.append((page, asyncio.ensure_future(
+                    self.afetch_page(page, page_size))))
+            while pending:
+                page, task = pending.popleft()
+                result_data = await task
+                next_page = next(remaining_pages, None)
+                if next_page is not None:
+                    pending.append((next_page, asyncio.ensure_future(
+                        self.afetch_page(next_page, page_size))))
+                yield self.trim_page(result_data, page, page_size)
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def afetch_page(self, page, page_size):
+        query_params = dict(self.query_params)
+        query_params.update({'$pagesize': page_size,
+                             '$page': page})
+        endpoint = self.queryset.model.Meta.endpoint
+        api_result = await self.queryset.api.get(endpoint, params=query_params)
+        return get_response_data(api_result)
+
+    async def acount(self):
+        """
+        Async version of :meth:`count`.
+        """
+        self.query_params = self.compile_query_params()
+        result_data = await self.afetch_page(1, 1)
+        return self.get_count(result_data)
+
+    def count(self):
+        """
+        Returns the number of results of the query by reading the pagination
+        metadata of a request for a single row.
+        """
+        self.query_params = self.compile_query_params()
+        result_data = self.fetch_page(1, 1)
+        return self.get_count(result_data)
+
+    def get_count(self, result_data):
+        query = self.queryset.query
+        count = self.get_meta(result_data).total_number_of_results or 0
+
+        if query.high_mark is not None:
+            count = min(count, query.high_mark)
+        return max(count - query.low_mark, 0)
+
+    def compile_query_params(self):
+        compiler = self.queryset.query.query_compiler(self.queryset.query)
+        compiler.compile()
+        return compiler.get_query_params()
+
+    def fetch_page(self, page, page_size):
+        return get_response_data(self.get_page_response(page, page_size))
+
+    def get_page_response(self, page, page_size, **kwargs):
+        query_params = dict(self.query_params)
+        query_params.update({'$pagesize': page_size,
+                             '$page': page})
+        endpoint = self.queryset.model.Meta.endpoint
+        return self.queryset.api.get(endpoint, params=query_params, **kwargs)
+
+    def fetch_pages_concurrently(self, pages, page_size, max_workers):
+        """
+        Fetches pages over a pool of max_workers threads but yields them in
+        the order they were given. At most max_workers pages are in flight or
+        waiting to be consumed at any time.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        pages = iter(pages)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque(executor.submit(self.fetch_page, page, page_size)
+                            for page in islice(pages, max_workers))
+            while pending:
+                result_data = pending.popleft().result()
+                next_page = next(pages, None)
+                if next_page is not None:
+                    pending.append(
+                        executor.submit(self.fetch_page, next_page, page_size))
+                yield result_data
+
+    def trim_page(self, result_data, page, page_size, offset=None):
+        """
+        Removes the rows of a page that are outside of the query limits or
+        before offset if it is given.
+        """
+        if offset is None:
+            offset = self.queryset.query.low_mark
+        high_mark = self.queryset.query.high_mark
+        page_start = (page - 1) * page_size
+        start = max(offset - page_start, 0)
+        stop = None if high_mark is None else high_mark - page_start
+
+        if start or stop is not None:
+            # A copy, since the data of a cached response is shared.
+            data_key = self.queryset.envelope.fields['data'].data_key
+            result_data = dict(result_data)
+            result_data[data_key] = result_data[data_key][start:stop]
+
+        return result_data
+
+    def get_aligned_page_size(self, low_mark, high_mark):
+        """
+        Returns the smallest page size where the rows between low_mark and
+        high_mark are all on the same page, or None if there is no such page
+        size within the maximum page size.
+        """
+        for page_size in range(high_mark - low_mark, self.MAX_PAGE_SIZE + 1):
+            if low_mark // page_size == (high_mark - 1) // page_size:
+                return page_size
+        return None
+
+    def get_total_number_of_pages(self, result_data):
+        return self.get_meta(result_data).total_number_of_pages
+
+    def get_meta(self, result_data):
+        meta_field = self.queryset.envelope.fields['meta']
+        return meta_field.deserialize(result_data.get(meta_field.data_key))
+
+
+def prefetch_related_objects(objs, lookups, api=None, fetched=None,
+                             batch_size=PREFETCH_BATCH_SIZE):
+    """
+    Attaches the related objects of lookups to objs. Instead of one request
+    per object the referenced ids of all objs are fetched together, up to
+    batch_size ids per request with an ``Id eq ... or Id eq ...`` filter.
+    Related models that can't be listed are fetched with a get per id over
+    a pool of threads, see :meth:`visma.manager.Manager.in_bulk`.
+
+    A lookup is the name of a relation declared with related in the model
+    Meta, and may follow nested fields, ex ``rows__article``. Objects already
+    in fetched, a dict by (model, id), are not fetched again.
+
+    Returns the number of requests made and the number of requests saved
+    compared to getting every related object on its own.
+    """
+    if fetched is None:
+        fetched = dict()
+    requests = 0
+    saved = 0
+
+    for lookup in lookups:
+        prefetch = _get_prefetch(objs, lookup, api, fetched)
+        if prefetch is None:
+            continue
+        manager, missing = prefetch[2:]
+        found = manager.in_bulk(missing, batch_size=batch_size)
+        lookup_requests, lookup_saved = _attach_related(
+            prefetch, found, fetched, batch_size)
+        requests += lookup_requests
+        saved += lookup_saved
+
+    return requests, saved
+
+
+async def aprefetch_related_objects(objs, lookups, api=None, fetched=None,
+                                    batch_size=PREFETCH_BATCH_SIZE):
+    """
+    Async version of :func:`prefetch_related_objects`.
+    """
+    if fetched is None:
+        fetched = dict()
+    requests = 0
+    saved = 0
+
+    for lookup in lookups:
+        prefetch = _get_prefetch(objs, lookup, api, fetched)
+        if prefetch is None:
+            continue
+        manager, missing = prefetch[2:]
+        found = await manager.ain_bulk(missing, batch_size=batch_size)
+        lookup_requests, lookup_saved = _attach_related(
+            prefetch, found, fetched, batch_size)
+        requests += lookup_requests
+        saved += lookup_saved
+
+    return requests, saved
+
+
+def _get_prefetch(objs, lookup, api, fetched):
+    """
+    Returns the instances of objs that lookup attaches a related object to,
+    their related descriptor, the manager of the related model and the ids
+    not in fetched yet, or None if there are no instances.
+    """
+    *path, related_name = lookup.split('__')
+    instances = list(objs)
+    for attr in path:
+        instances = _get_nested_objects(instances, attr)
+    if not instances:
+        return None
+
+    klass = type(instances[0])
+    if related_name not in getattr(klass, '_related', ()):
+        raise ValueError(
+            f'{klass.__name__} has no related object {related_name} '
+            f'in {lookup}')
+    descriptor = getattr(klass, related_name)
+    model = descriptor.model
+
+    instances = [instance for instance in instances
+                 if related_name not in instance._related_objects and
+                 getattr(instance, descriptor.field_name) is not None]
+    pks = {getattr(instance, descriptor.field_name)
+           for instance in instances}
+    missing = [pk for pk in pks if (model, pk) not in fetched]
+
+    manager = model.objects if api is None else model.objects.using(api)
+    return instances, descriptor, manager, missing
+
+
+def _attach_related(prefetch, found, fetched, batch_size):
+    """
+    Attaches the related objects to the instances of prefetch, found being
+    the objects fetched for its missing ids. Returns the number of requests
+    made and saved.
+    """
+    instances, descriptor, manager, missing = prefetch
+    model = descriptor.model
+    for pk, obj in found.items():
+        fetched[(model, pk)] = obj
+    for pk in missing:
+        fetched.setdefault((model, pk), None)
+    if manager.can_list:
+        batches = math.ceil(len(missing) / batch_size)
+    else:
+        batches = len(missing)
+
+    for instance in instances:
+        pk = getattr(instance, descriptor.field_name)
+        instance._related_objects[descriptor.name] = fetched[(model, pk)]
+
+    return batches, len(instances) - batches
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
+
+def _get_nested_objects(instances, attr):
+    nested_objects = []
+    for instance in instances:
+        value = getattr(instance, attr)
+        if isinstance(value, list):
+            nested_objects.extend(value)
+        elif value is not None:
+            nested_objects.append(value)
+    return nested_objects
+
+
+class RawIterable(APIModelIterable):
+    """
+    Yields the rows of the response as they are in the JSON, without
+    creating model objects.
+    """
+    copy_cached_pages = True
+
+    def prefetch_related(self, objs, lookups, fetched):
+        # There are no objects to attach related objects to.
+        pass
 
+    async def aprefetch_related(self, objs, lookups, fetched):
+        pass
+
+    def load_page(self, result_data):
+        if self.queryset.envelope:
+            data_key = self.queryset.envelope.fields['data'].data_key
+            return result_data[data_key]
+        else:
+            return [result_data]
 
-            if current_page == total_number_of_pages:
-                paginate = False
 
-            current_page += 1
+class ValuesIterable(RawIterable):
+    """
+    Yields a dict for each row with the model attribute names of the
+    requested fields as keys.
+    """
 
+    def get_data_keys(self):
+        model = self.queryset.model
+        field_names = self.queryset._fields or tuple(model._schema_items)
+        data_keys = []
+        for field_name in field_names:
+            field = model._schema_items.get(field_name)
+            if field is None:
+                raise ValueError(
+                    f'Model {model.__name__} does not have the attribute '
+                    f'{field_name}')
+            data_keys.append((field_name, field.data_key or field_name))
+        return data_keys
+
+    def load_page(self, result_data):
+        data_keys = self.get_data_keys()
+        return [{field_name: row.get(data_key)
+                 for field_name, data_key in data_keys}
+                for row in super().load_page(result_data)]
+
+
+class ValuesListIterable(ValuesIterable):
+    """
+    Yields a tuple for each row with the values of the requested fields.
+    """
+
+    def load_page(self, result_data):
+        data_keys = [data_key for _, data_key in self.get_data_keys()]
+        return [tuple(row.get(data_key) for data_key in data_keys)
+                for row in RawIterable.load_page(self, result_data)]
+
+
+class FlatValuesListIterable(ValuesIterable):
+    """
+    Yields the value of the single requested field for each row.
+    """
+
+    def load_page(self, result_data):
+        [(_, data_key)] = self.get_data_keys()
+        return [row.get(data_key)
+                for row in RawIterable.load_page(self, result_data)]
 
 
 class APIQuerySet:
@@ -128,6 +702,12 @@ class APIQuerySet:
         self._iterable_class = APIModelIterable  # TODO: Implemnt pagination over this.
         # TODO: How to handle different pagination?
         self._result_cache = None
+        self._count = None
+        self._fields = None
+        self._prefetch_related_lookups = ()
+        # Requests made and saved by prefetch_related.
+        self.prefetch_requests = 0
+        self.prefetch_requests_saved = 0
 
     def __repr__(self):
         data = list(self._result_cache[:REPR_OUTPUT_SIZE + 1])
@@ -140,6 +720,9 @@ class APIQuerySet:
         return iter(self._result_cache)
 
     def __len__(self):
+        # Use the count from .count() if the results haven't been needed.
+        if self._result_cache is None and self._count is not None:
+            return self._count
         self._fetch_all()
         return len(self._result_cache)
 
@@ -147,6 +730,14 @@ class APIQuerySet:
         self._fetch_all()
         return bool(self._result_cache)
 
+    def __aiter__(self):
+        return self._aiter()
+
+    async def _aiter(self):
+        await self._afetch_all()
+        for obj in self._result_cache:
+            yield obj
+
     def __getitem__(self, k):
         """Retrieve an item or slice from the set of results."""
         if not isinstance(k, (int, slice)):
@@ -159,12 +750,14 @@ class APIQuerySet:
         if self._result_cache is not None:
             return self._result_cache[k]
 
+        # Only fetch the pages needed for the requested items.
+        qs = self._chain()
         if isinstance(k, slice):
-            return list(self)[k.start:k.stop]
-
-        self._fetch_all()
+            qs.query.set_limits(k.start, k.stop)
+            return list(qs)[::k.step]
 
-        return self._result_cache[k]
+        qs.query.set_limits(k, k + 1)
+        return list(qs)[0]
 
     def filter(self, **kwargs):
         """
@@ -193,12 +786,138 @@ class APIQuerySet:
         obj.query.add_ordering(field_name)
         return obj
 
+    def values(self, *fields):
+        """
+        Return a new QuerySet instance that yields dicts of the given fields,
+        or all fields, instead of model objects. The values are taken straight
+        from the JSON response, so they are not deserialized or validated.
+        """
+        return self._chain(_fields=fields, _iterable_class=ValuesIterable)
+
+    def values_list(self, *fields, flat=False):
+        """
+        Return a new QuerySet instance that yields tuples of the given fields,
+        or the value itself if flat is True and one field is given.
+        """
+        if flat and len(fields) != 1:
+            raise TypeError('flat is only valid when values_list is called '
+                            'with a single field.')
+        if flat:
+            iterable_class = FlatValuesListIterable
+        else:
+            iterable_class = ValuesListIterable
+        return self._chain(_fields=fields, _iterable_class=iterable_class)
+
+    def raw(self):
+        """
+        Return a new QuerySet instance that yields the rows of the JSON
+        response as they are.
+        """
+        return self._chain(_iterable_class=RawIterable)
+
+    def prefetch_related(self, *lookups):
+        """
+        Return a new QuerySet instance that fetches the related objects of
+        lookups for each page of results in batches and attaches them to the
+        objects, instead of one request per object when they are accessed.
+
+        .. code-block:: python
+
+            CustomerInvoiceDraft.objects.all().prefetch_related(
+                'customer', 'rows__article')
+        """
+        obj = self._chain()
+        obj._prefetch_related_lookups = (self._prefetch_related_lookups +
+                                         lookups)
+        return obj
+
+    def using(self, client):
+        """
+        Return a new QuerySet instance that makes its requests with client,
+        or the client registered under that name.
+        """
+        if isinstance(client, str):
+            client = get_client(client)
+        obj = self._chain()
+        obj.api = client
+        return obj
+
+    def page_size(self, page_size):
+        """
+        Return a new QuerySet instance that fetches page_size objects per
+        request.
+        """
+        obj = self._chain()
+        obj.query.page_size = page_size
+        return obj
+
+    def count(self):
+        """
+        Return the number of objects matching the query. If the results
+        haven't been fetched the count is read from the pagination metadata
+        of a single one row request instead of fetching all pages.
+        """
+        if self._result_cache is not None:
+            return len(self._result_cache)
+
+        if not self.envelope:
+            return len(self)
+
+        if self._count is None:
+            self._count = self._iterable_class(self).count()
+        return self._count
+
+    async def acount(self):
+        """Async version of :meth:`count`."""
+        if self._result_cache is not None:
+            return len(self._result_cache)
+
+        if not self.envelope:
+            await self._afetch_all()
+            return len(self._result_cache)
+
+        if self._count is None:
+            self._count = await self._iterable_class(self).acount()
+        return self._count
+
+    def exists(self):
+        """
+        Return True if the query has any results. Like .count() it only makes
+        a single one row request if the results haven't been fetched.
+        """
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return self.count() > 0
+
+    def iterator(self, chunk_size=None):
+        """
+        An iterator over the results that fetches one page at a time instead
+        of loading all pages into the result cache. Only the current page
+        (and pages being fetched concurrently) is kept in memory.
+
+        :param int chunk_size: Number of objects to fetch per request.
+            Defaults to the page size of the iterable class.
+        """
+        return iter(self._iterable_class(self, chunk_size=chunk_size))
+
     def first(self):
         """Return the first object of a query or None if no match is found."""
-        if len(self) == 0:
-            return None
+        objs = self[:1]
+        if objs:
+            return objs[0]
         else:
-            return self[0]
+            return None
+
+    async def afirst(self):
+        """Async version of :meth:`first`."""
+        if self._result_cache is not None:
+            return self._result_cache[0] if self._result_cache else None
+
+        qs = self._chain()
+        qs.query.set_limits(0, 1)
+        async for obj in qs:
+            return obj
+        return None
 
     def _chain(self, **kwargs):
         """
@@ -217,11 +936,68 @@ class APIQuerySet:
         c = self.__class__(model=self.model, query=self.query.chain(),
                            api=self.api, schema=self.schema,
                            envelope=self.envelope)
+        c._iterable_class = self._iterable_class
+        c._fields = self._fields
+        c._prefetch_related_lookups = self._prefetch_related_lookups
         return c
 
     def _fetch_all(self):
-        if self._result_cache is None:
-            self._result_cache = list(self._iterable_class(self))
+        if self._result_cache is not None:
+            return
+        iterable = self._iterable_class(self)
+        if self._cache is None:
+            self._result_cache = list(iterable)
+            return
+
+        pages = self._get_cached_pages(iterable)
+        if pages is None:
+            pages = tuple(iterable.pages())
+            self._set_cached_pages(iterable, pages)
+        self._result_cache = list(iterable.load_pages(pages))
+
+    async def _afetch_all(self):
+        if self._result_cache is not None:
+            return
+        iterable = self._iterable_class(self)
+        if self._cache is None:
+            self._result_cache = [obj async for obj in iterable]
+            return
+
+        pages = self._get_cached_pages(iterable)
+        if pages is None:
+            pages = tuple([page async for page in iterable.apages()])
+            self._set_cached_pages(iterable, pages)
+        self._result_cache = [obj async for obj in
+                              iterable.aload_pages(_aiter(pages))]
+
+    @property
+    def _cache(self):
+        manager = getattr(self.model, 'objects', None)
+        return getattr(manager, 'cache', None)
+
+    def _get_cache_key(self):
+        query = self.query
+        return (get_client_key(self.api), self._iterable_class.__name__,
+                repr(sorted(query.filter_by.items())),
+                repr(sorted(query.exclude_by.items())),
+                tuple(query.order_by), query.low_mark, query.high_mark,
+                self._fields, self._prefetch_related_lookups)
+
+    def _get_cached_pages(self, iterable):
+        """
+        The result data of the pages from the model cache. New objects are
+        loaded from them for every queryset, so changes to the objects of
+        one don't show up in the others.
+        """
+        pages = self._cache.get(self._get_cache_key())
+        if pages is not None and iterable.copy_cached_pages:
+            pages = copy.deepcopy(pages)
+        return pages
+
+    def _set_cached_pages(self, iterable, pages):
+        if iterable.copy_cached_pages:
+            pages = copy.deepcopy(pages)
+        self._cache.set(self._get_cache_key(), pages)
 
 
 class APIQuery:
@@ -232,6 +1008,9 @@ class APIQuery:
         self.filter_by = {}
         self.exclude_by = {}
         self.order_by = []
+        self.low_mark = 0
+        self.high_mark = None
+        self.page_size = None
 
     def add_filter(self, negate, **kwargs):
         # TODO: Validate that it is possible to filter.
@@ -245,6 +1024,23 @@ class APIQuery:
         """Will keep all the fields"""
         self.order_by.append(field_name)
 
+    def set_limits(self, low=None, high=None):
+        """
+        Adjust the limits on the rows retrieved. Any limits passed in here are
+        applied relative to the existing constraints. So low is added to the
+        current low value and both will be clamped to any existing high value.
+        """
+        if high is not None:
+            if self.high_mark is not None:
+                self.high_mark = min(self.high_mark, self.low_mark + high)
+            else:
+                self.high_mark = self.low_mark + high
+        if low is not None:
+            if self.high_mark is not None:
+                self.low_mark = min(self.high_mark, self.low_mark + low)
+            else:
+                self.low_mark = self.low_mark + low
+
     def chain(self, klass=None):
         """
         Return a copy of the current Query that's ready for another operation.
@@ -265,6 +1061,9 @@ class APIQuery:
         c.filter_by = self.filter_by
         c.exclude_by = self.exclude_by
         c.order_by = self.order_by
+        c.low_mark = self.low_mark
+        c.high_mark = self.high_mark
+        c.page_size = self.page_size
         return c
 
 
@@ -300,7 +1099,8 @@ class Filter:
 
 
 class Equals(Filter):
-    allowed_input_value_types = [int, float, str, uuid.UUID]
+    allowed_input_value_types = [int, float, str, uuid.UUID, datetime.datetime,
+                                 datetime.date]
 
 
 class NotEquals(Filter):
@@ -308,19 +1108,27 @@ class NotEquals(Filter):
 
 
 class GreaterThan(Filter):
-    allowed_input_value_types = [int, float]
+    allowed_input_value_types = [int, float, datetime.datetime, datetime.date]
 
 
 class GreaterThanOrEqual(Filter):
-    allowed_input_value_types = [int, float]
+    allowed_input_value_types = [int, float, datetime.datetime, datetime.date]
 
 
 class LessThan(Filter):
-    allowed_input_value_types = [int, float]
+    allowed_input_value_types = [int, float, datetime.datetime, datetime.date]
 
 
 class LessThanOrEquals(Filter):
-    allowed_input_value_types = [int, float]
+    allowed_input_value_types = [int, float, datetime.datetime, datetime.date]
+
+
+class In(Filter):
+    allowed_input_value_types = [list, tuple, set, frozenset]
+
+
+class NotIn(Filter):
+    allowed_input_value_types = [list, tuple, set, frozenset]
 
 
 class OrderBy(Filter):
@@ -359,6 +1167,8 @@ class QueryCompiler:
     greater_or_equal_parser_class = NoneFilterParser
     less_than_parser_class = NoneFilterParser
     less_or_equal_parser_class = NoneFilterParser
+    in_parser_class = NoneFilterParser
+    not_in_parser_class = NoneFilterParser
 
     order_by_parser_class = NoneFilterParser
 
@@ -378,8 +1188,8 @@ class QueryCompiler:
             'gt': (GreaterThan, self.greater_than_parser_class),
             'gte': (GreaterThanOrEqual, self.greater_or_equal_parser_class),
             'lt': (LessThan, self.less_than_parser_class),
-            'lte': (LessThanOrEquals, self.less_or_equal_parser_class)
-
+            'lte': (LessThanOrEquals, self.less_or_equal_parser_class),
+            'in': (In, self.in_parser_class),
         }
 
     @property
@@ -391,6 +1201,7 @@ class QueryCompiler:
             'gte': (LessThanOrEquals, self.less_or_equal_parser_class),
             'lt': (GreaterThan, self.greater_than_parser_class),
             'lte': (GreaterThanOrEqual, self.greater_or_equal_parser_class),
+            'in': (NotIn, self.not_in_parser_class),
         }
 
     def compile(self):
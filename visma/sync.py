@@ -0,0 +1,100 @@
+"""
+Incremental sync of objects changed since the last run.
+"""
+import datetime
+import json
+import os
+
+import iso8601
+
+from visma.utils import file_lock
+
+
+def as_utc(value):
+    """
+    Returns value as a datetime in UTC without time zone, like the times
+    loaded from the API.
+    """
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class WatermarkStore:
+    """
+    Keeps the time of the latest change seen by each sync, per model and
+    tenant, in a JSON file at path, with the objects seen shortly before it.
+    The file is locked while it is updated so it can be shared by several
+    processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, name, tenant):
+        """
+        Returns the watermark of model name for tenant, or None.
+        """
+        value = self._get_entry(name, tenant).get('time')
+        return None if value is None else as_utc(iso8601.parse_date(value))
+
+    def get_seen(self, name, tenant):
+        """
+        Returns the objects seen by the last sync of model name for tenant
+        close to the watermark, as a set of (id, time of change).
+        """
+        return {(pk, as_utc(iso8601.parse_date(changed)))
+                for pk, changed in self._get_entry(name, tenant).get(
+                    'seen', ())}
+
+    def set(self, name, tenant, value, seen=()):
+        """
+        Saves the watermark of model name for tenant, and the objects seen
+        close to it as (id, time of change).
+        """
+        entry = {'time': as_utc(value).isoformat(),
+                 'seen': [[str(pk), as_utc(changed).isoformat()]
+                          for pk, changed in seen]}
+        with file_lock(self.path):
+            watermarks = self._read()
+            watermarks.setdefault(str(tenant), dict())[name] = entry
+            self._write(watermarks)
+
+    def _get_entry(self, name, tenant):
+        with file_lock(self.path):
+            watermarks = self._read()
+        entry = watermarks.get(str(tenant), dict()).get(name) or dict()
+        if isinstance(entry, str):
+            # Saved by an earlier version with only the time.
+            entry = {'time': entry}
+        return entry
+
+    def reset(self, name=None, tenant=None):
+        """
+        Removes the watermarks of model name and tenant, so the next sync
+        fetches all objects. Removes all watermarks of a tenant if no name is
+        given, or of the model for all tenants if no tenant is given.
+        """
+        with file_lock(self.path):
+            watermarks = self._read()
+            for watermark_tenant in list(watermarks):
+                if tenant is not None and watermark_tenant != str(tenant):
+                    continue
+                if name is None:
+                    del watermarks[watermark_tenant]
+                else:
+                    watermarks[watermark_tenant].pop(name, None)
+            self._write(watermarks)
+
+    def _read(self):
+        try:
+            with open(self.path) as watermark_file:
+                return json.load(watermark_file)
+        except FileNotFoundError:
+            return dict()
+
+    def _write(self, watermarks):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as watermark_file:
+            json.dump(watermarks, watermark_file)
+        os.replace(tmp_path, self.path)
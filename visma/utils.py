@@ -1,6 +1,12 @@
+from contextlib import contextmanager
 from importlib import import_module
 from os import environ
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 def import_string(dotted_path):
     """
@@ -30,4 +36,23 @@ def is_instance_or_subclass(val, class_):
     try:
         return issubclass(val, class_)
     except TypeError:
-        return isinstance(val, class_)
\ No newline at end of file
+        return isinstance(val, class_)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock between processes on the file ``path``, taken on a
+    separate ``.lock`` file next to it. Does nothing if path is None or
+    file locking isn't available on the platform.
+    """
+    if path is None or fcntl is None:
+        yield
+        return
+
+    with open(f'{path}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)